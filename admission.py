@@ -0,0 +1,57 @@
+from typing import Any, Dict
+
+from db import pool_stats
+
+
+class Admission:
+    """
+    Webhook yuklama nazorati (load shedding).
+
+    Bir vaqtda ishlayotgan feed_update soni yoki pool.acquire() kutish vaqti
+    chegaradan oshsa, yangi update qabul qilinmaydi — webhook 429 qaytaradi,
+    Telegram esa keyinroq qayta yuboradi. Adminlar update'lari bunga kirmaydi.
+    """
+
+    def __init__(self, *, max_inflight: int, max_pool_wait_ms: float) -> None:
+        self._max_inflight = int(max_inflight)
+        self._max_pool_wait_ms = float(max_pool_wait_ms)
+        self.inflight = 0
+        self.shed = 0
+        self.exempted = 0
+
+    def overloaded(self) -> bool:
+        if self._max_inflight > 0 and self.inflight >= self._max_inflight:
+            return True
+
+        # faqat hozir kimdir pool'ni kutayotgan bo'lsa — eski EWMA qiymati
+        # yuklama tugagandan keyin ham shedding'ni ushlab turmasin
+        ps = pool_stats()
+        if self._max_pool_wait_ms > 0 and ps["waiting"] > 0 and ps["wait_ms"] >= self._max_pool_wait_ms:
+            return True
+
+        return False
+
+    def admit(self, *, exempt: bool = False) -> bool:
+        if not self.overloaded():
+            return True
+        if exempt:
+            self.exempted += 1
+            return True
+        self.shed += 1
+        return False
+
+    def enter(self) -> None:
+        self.inflight += 1
+
+    def leave(self) -> None:
+        self.inflight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self._max_inflight,
+            "max_pool_wait_ms": self._max_pool_wait_ms,
+            "shed": self.shed,
+            "exempted": self.exempted,
+            "pool": pool_stats(),
+        }
@@ -0,0 +1,94 @@
+"""
+Webhook body -> Update: eski (request.json + model_validate) va
+main._decode_update ishlatadigan yo'llarni solishtirish.
+
+    python benchmarks/bench_webhook_decode.py [n]
+
+Natija: min(repeat) — shovqinli mashinada ham barqaror.
+"""
+import json
+import sys
+import timeit
+
+from aiogram.types import Update
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+MESSAGE_UPDATE = {
+    "update_id": 912345678,
+    "message": {
+        "message_id": 4242,
+        "from": {
+            "id": 123456789,
+            "is_bot": False,
+            "first_name": "Ali",
+            "last_name": "Valiyev",
+            "username": "ali_v",
+            "language_code": "uz",
+        },
+        "chat": {
+            "id": 123456789,
+            "first_name": "Ali",
+            "last_name": "Valiyev",
+            "username": "ali_v",
+            "type": "private",
+        },
+        "date": 1760700000,
+        "text": "/start ref987654321",
+        "entities": [{"offset": 0, "length": 6, "type": "bot_command"}],
+    },
+}
+
+CALLBACK_UPDATE = {
+    "update_id": 912345679,
+    "callback_query": {
+        "id": "5300000000000000000",
+        "from": {"id": 123456789, "is_bot": False, "first_name": "Ali", "username": "ali_v"},
+        "message": {
+            "message_id": 4243,
+            "from": {"id": 7000000000, "is_bot": True, "first_name": "Bot", "username": "ref_bot"},
+            "chat": {"id": 123456789, "first_name": "Ali", "type": "private"},
+            "date": 1760700001,
+            "text": "Asosiy menyu",
+            "reply_markup": {
+                "inline_keyboard": [
+                    [{"text": "Ishtirok etish", "callback_data": "join_flow"}],
+                    [{"text": "Mening natijam", "callback_data": "my_stats"}],
+                    [{"text": "Top-10", "callback_data": "show_top"}],
+                    [{"text": "Sovg'alar", "callback_data": "show_prizes"}],
+                ]
+            },
+        },
+        "chat_instance": "-123456789012345678",
+        "data": "confirm_sub",
+    },
+}
+
+
+def bench(name: str, fn, body: bytes, n: int) -> float:
+    us = min(timeit.repeat(lambda: fn(body), number=n, repeat=7)) / n * 1e6
+    print(f"  {name:<32} {us:8.2f} us/update")
+    return us
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    for label, payload in (("message", MESSAGE_UPDATE), ("callback_query", CALLBACK_UPDATE)):
+        body = json.dumps(payload).encode()
+        print(f"{label} ({len(body)} bytes, n={n})")
+
+        old = bench("json.loads + model_validate", lambda b: Update.model_validate(json.loads(b)), body, n)
+        bench("model_validate_json", Update.model_validate_json, body, n)
+        if orjson is not None:
+            new = bench("orjson.loads + model_validate", lambda b: Update.model_validate(orjson.loads(b)), body, n)
+            print(f"  orjson yo'li tejaydi: {old - new:.2f} us/update ({(1 - new / old) * 100:.0f}%)")
+        print()
+
+
+if __name__ == "__main__":
+    main()
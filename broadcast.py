@@ -0,0 +1,230 @@
+"""
+/msg broadcast'larini fonda yuborish (faqat leader process'da).
+
+Job broadcast_jobs jadvalida turadi. Runner user'larni user_id bo'yicha
+chunk'lab oladi, har chunk'ni BROADCAST_CONCURRENCY parallellikda yuboradi
+(tezlik — ratelimit.py) va chunk tugagach cursor + sent/failed'ni yozadi.
+Bot'ni bloklagan ("chat not found" ham) user'lar users.blocked_at bilan
+belgilanadi va keyingi broadcast'larda tanlanmaydi; /start bossa qaytadi.
+Process o'lsa yangi leader job'ni cursor'dan davom ettiradi — ko'pi bilan
+bitta chunk qayta yuborilishi mumkin. Runner job'da ketma-ket
+BROADCAST_MAX_ERRORS marta xato qilsa job 'failed' bo'ladi (xato matni
+/bc_status'da) va navbatdagi job'lar davom etadi.
+Matn/caption va reklama /msg paytida bir marta tayyorlanadi (compile_payload);
+har user uchun faqat oldindan bog'langan sender(chat_id=uid) chaqiriladi.
+"""
+import asyncio
+import logging
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, Message
+
+from config import (
+    BROADCAST_CHUNK, BROADCAST_CONCURRENCY, BROADCAST_MAX_ERRORS, BROADCAST_MEDIA_MODE,
+    BROADCAST_POLL_INTERVAL, BROADCAST_RETRY_MAX,
+)
+import db
+from keyboards import kb_ad_button_json
+from ratelimit import bulk
+from utils import merge_text_with_ad
+
+log = logging.getLogger(__name__)
+
+_wakeup = asyncio.Event()
+
+_counters: Dict[str, Any] = {"job_id": None, "sent": 0, "failed": 0, "blocked": 0, "retry_after": 0, "job_errors": 0}
+
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+
+
+async def broadcast_wakeup(_payload: Optional[str] = None) -> None:
+    # notify.py: BROADCAST_CHANNEL (yangi job yoki bekor qilish)
+    _wakeup.set()
+
+
+def broadcast_stats() -> Dict[str, Any]:
+    return dict(_counters)
+
+
+# =========================
+# Payload (job yaratilganda bir marta)
+# =========================
+# BROADCAST_MEDIA_MODE=file_id: Message atributi -> bot.send_<turi>(<turi>=file_id)
+_MEDIA_TYPES = ("photo", "video", "animation", "document", "audio", "voice")
+
+
+def _media_file_id(src: Message) -> Tuple[Optional[str], Optional[str]]:
+    for kind in _MEDIA_TYPES:
+        media = getattr(src, kind, None)
+        if not media:
+            continue
+        if kind == "photo":
+            media = media[-1]  # eng katta o'lcham
+        return kind, media.file_id
+    return None, None
+
+
+async def _render(src_text: Optional[str], src_caption: Optional[str], extra_text: str) -> Dict[str, Any]:
+    base = src_text if src_text is not None else (src_caption or "")
+    combined = (extra_text + "\n\n" + base).strip() if extra_text else base
+    text = await merge_text_with_ad(combined)
+    if src_text is None:
+        text = text.strip()
+
+    return {
+        "payload_text": text,
+        "reply_markup": await kb_ad_button_json(),
+    }
+
+
+async def compile_payload(src: Message, extra_text: str) -> Dict[str, Any]:
+    """
+    /msg: matn/caption + reklama footer + reklama tugmasi shu yerda bir marta
+    yig'iladi va job'da saqlanadi — runner har user uchun faqat yuboradi.
+    """
+    payload = await _render(src.text, src.caption, extra_text)
+    payload["media_type"] = payload["media_file_id"] = None
+    if src.text is None and BROADCAST_MEDIA_MODE == "file_id":
+        payload["media_type"], payload["media_file_id"] = _media_file_id(src)
+    return payload
+
+
+Sender = Callable[..., Awaitable[Any]]
+
+
+async def _make_sender(bot: Bot, job: Any) -> Sender:
+    """
+    Job -> sender(chat_id=uid). Hamma argumentlar oldindan bog'langan.
+    """
+    if job["rendered"]:
+        text = job["payload_text"]
+        markup_json = job["reply_markup"]
+    else:
+        # migratsiyadan oldin yaratilgan job — runner boshida bir marta
+        p = await _render(job["src_text"], job["src_caption"], job["extra_text"])
+        text, markup_json = p["payload_text"], p["reply_markup"]
+
+    markup = InlineKeyboardMarkup.model_validate_json(markup_json) if markup_json else None
+
+    # TEXT bo'lsa
+    if job["src_text"] is not None:
+        return partial(bot.send_message, text=text, reply_markup=markup)
+
+    # MEDIA bo'lsa
+    caption = text if text else None
+    kind = job["media_type"]
+    if kind in _MEDIA_TYPES and job["media_file_id"]:
+        return partial(
+            getattr(bot, f"send_{kind}"),
+            **{kind: job["media_file_id"]},
+            caption=caption,
+            reply_markup=markup,
+        )
+
+    return partial(
+        bot.copy_message,
+        from_chat_id=job["src_chat_id"],
+        message_id=job["src_message_id"],
+        caption=caption,
+        reply_markup=markup,
+    )
+
+
+async def _send_one(sender: Sender, uid: int) -> str:
+    attempt = 0
+    while True:
+        try:
+            with bulk():
+                await sender(chat_id=uid)
+            return SENT
+        except TelegramRetryAfter as e:
+            # ratelimit.py qayta urinib ko'rib bo'lgan — shu user'ni kutib qayta yuboramiz,
+            # lekin cheksiz emas: bitta user butun chunk'ni ushlab turmasin
+            _counters["retry_after"] += 1
+            if attempt >= BROADCAST_RETRY_MAX:
+                return FAILED
+            attempt += 1
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            # bot bloklangan / user o'chirilgan
+            return BLOCKED
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e.message).lower():
+                return BLOCKED
+            return FAILED
+        except Exception:
+            return FAILED
+
+
+async def _run_job(bot: Bot, job: Any) -> None:
+    job_id = int(job["id"])
+    cursor = int(job["cursor_user_id"])
+    sem = asyncio.Semaphore(max(1, BROADCAST_CONCURRENCY))
+    log.info("broadcast #%s: cursor=%s dan boshlanmoqda", job_id, cursor)
+
+    sender = await _make_sender(bot, job)
+
+    async def send(uid: int) -> str:
+        async with sem:
+            return await _send_one(sender, uid)
+
+    segment = db.job_segment(job)
+    async for ids in db.iter_recipients(segment, after_user_id=cursor, chunk=BROADCAST_CHUNK):
+        results = await asyncio.gather(*(send(uid) for uid in ids))
+        sent = results.count(SENT)
+        failed = results.count(FAILED)
+        blocked = [uid for uid, r in zip(ids, results) if r == BLOCKED]
+        _counters["sent"] += sent
+        _counters["failed"] += failed
+        _counters["blocked"] += len(blocked)
+        cursor = ids[-1]
+
+        status = await db.broadcast_progress(job_id, cursor, sent, failed, blocked)
+        if status != "running":
+            log.info("broadcast #%s to'xtatildi (%s)", job_id, status)
+            break
+    else:
+        await db.broadcast_finish(job_id)
+        log.info("broadcast #%s tugadi", job_id)
+
+
+async def broadcast_loop(bot: Bot) -> None:
+    """
+    leader.background orqali ishga tushadi; leadership yo'qolsa cancel bo'ladi.
+    """
+    while True:
+        _wakeup.clear()
+        try:
+            job = await db.broadcast_next()
+        except Exception:
+            log.exception("broadcast runner xato")
+            job = None
+
+        if job is not None:
+            _counters["job_id"] = int(job["id"])
+            try:
+                await _run_job(bot, job)
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception("broadcast #%s xato", job["id"])
+                _counters["job_errors"] += 1
+                try:
+                    status = await db.broadcast_error(int(job["id"]), repr(e), BROADCAST_MAX_ERRORS)
+                    if status == "failed":
+                        # navbatdagi job'ni poll oralig'ini kutmasdan olamiz
+                        log.error("broadcast #%s: %s ta xatodan keyin to'xtatildi", job["id"], BROADCAST_MAX_ERRORS)
+                        continue
+                except Exception:
+                    log.exception("broadcast #%s xatosini yozib bo'lmadi", job["id"])
+            finally:
+                _counters["job_id"] = None
+
+        try:
+            await asyncio.wait_for(_wakeup.wait(), BROADCAST_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
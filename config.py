@@ -10,6 +10,17 @@ DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 8))
 DB_COMMAND_TIMEOUT = int(os.getenv("DB_COMMAND_TIMEOUT", 30))
 DB_MAX_INACTIVE_LIFETIME = int(os.getenv("DB_MAX_INACTIVE_LIFETIME", 60))
 
+# ko'p process rejimi: uvicorn worker soni (uvicorn CLI ham shu env'ni o'qiydi)
+# va replikalar soni. DB_CONN_BUDGET berilsa — bu barcha process'lar uchun
+# umumiy Postgres connection limiti; har bir worker pool'i shundan bo'linadi
+# (har process'da 2 ta connection alohida: leader lock va LISTEN).
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+APP_REPLICAS = max(1, int(os.getenv("APP_REPLICAS", 1)))
+DB_CONN_BUDGET = int(os.getenv("DB_CONN_BUDGET", 0))
+if DB_CONN_BUDGET > 0:
+    DB_POOL_MAX = max(2, DB_CONN_BUDGET // (WEB_CONCURRENCY * APP_REPLICAS) - 2)
+    DB_POOL_MIN = min(DB_POOL_MIN, DB_POOL_MAX)
+
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 BOT_USERNAME = os.getenv("BOT_USERNAME", "").strip().lstrip("@")
 
@@ -25,9 +36,74 @@ CHANNELS = [
     if x.strip()
 ]
 
+# in-memory reyting DB bilan qanchalik tez-tez solishtiriladi (sekund)
+LEADERBOARD_SYNC_INTERVAL = float(os.getenv("LEADERBOARD_SYNC_INTERVAL", 30))
+
+# getChatMember natijalari cache'i (user_id, kanal) -> a'zomi:
+#   a'zo bo'lsa uzoq, a'zo bo'lmasa qisqa saqlanadi (sekund)
+SUB_CACHE_SIZE = int(os.getenv("SUB_CACHE_SIZE", 50000))
+SUB_CACHE_MEMBER_TTL = float(os.getenv("SUB_CACHE_MEMBER_TTL", 600))
+SUB_CACHE_NOT_MEMBER_TTL = float(os.getenv("SUB_CACHE_NOT_MEMBER_TTL", 15))
+# kanal @username'i getChat bilan resolve bo'lmasa — shuncha sekund qayta urinilmaydi
+SUB_RESOLVE_FAIL_TTL = float(os.getenv("SUB_RESOLVE_FAIL_TTL", 300))
+
+# bir user'ning parallel obuna tekshiruvlari bitta bo'ladi; natija shuncha
+# sekund qayta ishlatiladi (ketma-ket bosishlar uchun)
+SUB_SINGLEFLIGHT_REUSE = float(os.getenv("SUB_SINGLEFLIGHT_REUSE", 2))
+
+# Bot API chiqish limitlari (ratelimit.py). Telegram limiti bot token bo'yicha
+# (~30 msg/s). Broadcast faqat leader process'da yuradi — uning ulushi
+# (RATE_BROADCAST_SENDS) alohida bucket, faqat broadcast yuborishlari ishlatadi;
+# qolgani interaktiv javoblar uchun hamma process'larga bo'linadi.
+# getChatMember budjeti ham process'lar soniga bo'linadi
+_BOT_PROCS = WEB_CONCURRENCY * APP_REPLICAS
+_SEND_BUDGET = 30.0
+RATE_BROADCAST_SENDS = float(os.getenv("RATE_BROADCAST_SENDS", 20))
+RATE_GLOBAL_SENDS = float(os.getenv(
+    "RATE_GLOBAL_SENDS", max(1.0, _SEND_BUDGET - RATE_BROADCAST_SENDS) / _BOT_PROCS
+))
+RATE_GET_CHAT_MEMBER = float(os.getenv("RATE_GET_CHAT_MEMBER", 30 / _BOT_PROCS))
+RATE_PER_CHAT = float(os.getenv("RATE_PER_CHAT", 1))
+RATE_PER_CHAT_BURST = float(os.getenv("RATE_PER_CHAT_BURST", 3))
+RATE_GROUP_PER_MIN = float(os.getenv("RATE_GROUP_PER_MIN", 20))
+RATE_RETRY_MAX = int(os.getenv("RATE_RETRY_MAX", 3))
+
+# /msg broadcast runner (leader'da): bir vaqtda nechta yuborish, chunk hajmi
+# (progress shu chunk'dan keyin DB'ga yoziladi), yangi job'ni tekshirish oralig'i
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 8))
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", 200))
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", 30))
+# job ketma-ket shuncha marta xato bilan to'xtasa — 'failed' (navbatdagilar davom etadi);
+# bitta user'ga RetryAfter'dan keyin ko'pi bilan shuncha qayta urinish
+BROADCAST_MAX_ERRORS = int(os.getenv("BROADCAST_MAX_ERRORS", 5))
+BROADCAST_RETRY_MAX = int(os.getenv("BROADCAST_RETRY_MAX", 5))
+# media post'lar: copy — copyMessage (asl xabardan), file_id — media bir marta
+# yuklangan file_id bilan send_photo/send_video/... (asl xabar o'chsa ham ishlaydi)
+BROADCAST_MEDIA_MODE = os.getenv("BROADCAST_MEDIA_MODE", "copy").strip().lower()
+
+# webhook update'larni qabul qilish rejimi:
+#   inline — update webhook request ichida qayta ishlanadi (eski xulq)
+#   queue  — update navbatga qo'yiladi, webhook darhol 200 qaytaradi
+UPDATE_MODE = os.getenv("UPDATE_MODE", "inline").strip().lower()
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+# worker = shard: bitta user update'lari doim bitta worker'da, ketma-ket
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+# shutdown'da navbatdagi update'larni oxirigacha qayta ishlash (1) yoki tashlab ketish (0)
+UPDATE_DRAIN_ON_SHUTDOWN = os.getenv("UPDATE_DRAIN_ON_SHUTDOWN", "1") == "1"
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", 10))
+# oxirgi nechta update_id eslab qolinadi (Telegram retry dedup)
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", 10000))
+
+# load shedding: chegaradan oshsa webhook 429 qaytaradi (0 — o'chirilgan)
+SHED_MAX_INFLIGHT = int(os.getenv("SHED_MAX_INFLIGHT", DB_POOL_MAX * 4))
+SHED_POOL_WAIT_MS = float(os.getenv("SHED_POOL_WAIT_MS", 250))
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", 1))
+
 # webhook uchun
 BASE_URL = os.getenv("BASE_URL", "").rstrip("/")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# deployda Telegram'da yig'ilib qolgan update'larni tashlash — faqat aniq so'ralsa (1)
+WEBHOOK_DROP_PENDING = os.getenv("WEBHOOK_DROP_PENDING", "0") == "1"
 
 if ENV == "prod":
     if not BASE_URL:
@@ -1,7 +1,12 @@
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Set, Tuple, Dict, Any
+
 import asyncpg
-from typing import List, Optional, Tuple, Dict, Any
 
 from config import DATABASE_URL, ENV_ADMIN_IDS
+from migrations import SCORES_BACKFILL_SQL, STATS_BACKFILL_SQL, run_migrations
 
 # ixtiyoriy env config (bo'lmasa default ishlaydi)
 try:
@@ -15,6 +20,11 @@ except Exception:
 
 _pool: Optional[asyncpg.Pool] = None
 
+# pool.acquire() kutish vaqti — admission control (main.py) shu bilan yuklamani o'lchaydi
+_POOL_WAIT_ALPHA = 0.2
+_pool_wait_ewma: float = 0.0
+_pool_waiting: int = 0
+
 
 # =========================
 # Connection / Init
@@ -39,6 +49,40 @@ async def db_connect() -> asyncpg.Pool:
     return _pool
 
 
+@asynccontextmanager
+async def _acquire(pool: asyncpg.Pool) -> AsyncIterator[asyncpg.Connection]:
+    """
+    pool.acquire() + kutish vaqtini o'lchash (EWMA) va hozir kutayotganlar soni.
+    """
+    global _pool_wait_ewma, _pool_waiting
+
+    t0 = time.monotonic()
+    _pool_waiting += 1
+    waiting = True
+    try:
+        async with pool.acquire() as conn:
+            _pool_waiting -= 1
+            waiting = False
+            waited = time.monotonic() - t0
+            _pool_wait_ewma += _POOL_WAIT_ALPHA * (waited - _pool_wait_ewma)
+            yield conn
+    finally:
+        if waiting:
+            _pool_waiting -= 1
+
+
+def pool_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = {
+        "wait_ms": round(_pool_wait_ewma * 1000, 2),
+        "waiting": _pool_waiting,
+    }
+    if _pool is not None:
+        stats["size"] = _pool.get_size()
+        stats["idle"] = _pool.get_idle_size()
+        stats["max"] = _pool.get_max_size()
+    return stats
+
+
 async def db_close() -> None:
     global _pool
     if _pool is not None:
@@ -48,150 +92,127 @@ async def db_close() -> None:
 
 async def db_init() -> None:
     """
-    Schema + defaults + env adminlar.
+    Schema migratsiyalari + env adminlar (migrations.py).
+    Schema yangi bo'lsa — bitta query.
     """
     pool = await db_connect()
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            # ---- schema ----
-            await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-              user_id BIGINT PRIMARY KEY,
-              username TEXT,
-              first_name TEXT,
-              referrer_id BIGINT NULL,
-              verified BOOLEAN NOT NULL DEFAULT FALSE,
-              verified_at TIMESTAMPTZ NULL,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            """)
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer_id);")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at);")
-
-            await conn.execute("""
-            CREATE TABLE IF NOT EXISTS channels (
-              id BIGSERIAL PRIMARY KEY,
-              username TEXT UNIQUE NOT NULL,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            """)
-
-            await conn.execute("""
-            CREATE TABLE IF NOT EXISTS referrals (
-              invited_user_id BIGINT PRIMARY KEY,
-              referrer_id BIGINT NOT NULL,
-              credited BOOLEAN NOT NULL DEFAULT FALSE,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            """)
-            # invited_user_id PRIMARY KEY bo'lgani uchun unique index shart emas,
-            # lekin oldingi DB bilan moslik uchun qoldiramiz
-            await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_referrals_invited ON referrals(invited_user_id);")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_credited_referrer ON referrals(referrer_id, credited);")
-
-            await conn.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-              key TEXT PRIMARY KEY,
-              value TEXT NOT NULL
-            );
-            """)
-
-            await conn.execute("""
-            CREATE TABLE IF NOT EXISTS admins (
-              user_id BIGINT PRIMARY KEY,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            """)
-
-            await conn.execute("""
-            CREATE TABLE IF NOT EXISTS prizes (
-              id BIGSERIAL PRIMARY KEY,
-              place INT NOT NULL,
-              title TEXT NOT NULL,
-              description TEXT NOT NULL DEFAULT '',
-              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-            """)
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_prizes_place ON prizes(place);")
-
-            # ---- defaults ----
-            await conn.execute("""
-            INSERT INTO settings(key, value) VALUES
-              ('contest_active','1'),
-              ('ad_footer',''),
-              ('ad_btn_text',''),
-              ('ad_btn_url','')
-            ON CONFLICT (key) DO NOTHING;
-            """)
-
-            # ---- env admins ----
-            for aid in ENV_ADMIN_IDS:
-                await conn.execute(
-                    "INSERT INTO admins(user_id) VALUES($1) ON CONFLICT (user_id) DO NOTHING",
-                    int(aid),
-                )
+    async with _acquire(pool) as conn:
+        await run_migrations(conn)
 
 
 # =========================
 # Admin stats
 # =========================
-async def admin_stats() -> Dict[str, Any]:
-    pool = await db_connect()
-    async with pool.acquire() as conn:
-        users_total = int(await conn.fetchval("SELECT COUNT(*) FROM users"))
-        users_verified = int(await conn.fetchval("SELECT COUNT(*) FROM users WHERE verified=TRUE"))
-        users_not_verified = int(await conn.fetchval("SELECT COUNT(*) FROM users WHERE verified=FALSE"))
-
-        ref_total = int(await conn.fetchval("SELECT COUNT(*) FROM referrals"))
-        ref_credited = int(await conn.fetchval("SELECT COUNT(*) FROM referrals WHERE credited=TRUE"))
-        ref_not_credited = int(await conn.fetchval("SELECT COUNT(*) FROM referrals WHERE credited=FALSE"))
-
-        today_users = int(await conn.fetchval("SELECT COUNT(*) FROM users WHERE created_at::date = CURRENT_DATE"))
-        today_referrals = int(await conn.fetchval("SELECT COUNT(*) FROM referrals WHERE created_at::date = CURRENT_DATE"))
+# stats_counters'ga yozuvchi CTE bo'lagi (write path'lar shu bilan hisoblagichni yuritadi).
+# Bitta issiq qatorda lock navbati bo'lmasligi uchun har yozuv tasodifiy slot'ga tushadi.
+# source ko'pi bilan 1 qator qaytarishi kerak.
+_COUNTER_SLOTS = 8
+
+
+def _bump_counter(name: str, source: str, delta: str = "1") -> str:
+    return f"""
+        INSERT INTO stats_counters(name, day, slot, value)
+        SELECT '{name}', created_at::date, floor(random() * {_COUNTER_SLOTS})::smallint, {delta}
+        FROM {source}
+        ON CONFLICT (name, day, slot) DO UPDATE SET value = stats_counters.value + EXCLUDED.value
+    """
 
-        today_verified_created = int(await conn.fetchval("""
-            SELECT COUNT(*) FROM users
-            WHERE verified=TRUE AND created_at::date = CURRENT_DATE
-        """))
 
-        prizes_count = int(await conn.fetchval("SELECT COUNT(*) FROM prizes"))
-        channels_count = int(await conn.fetchval("SELECT COUNT(*) FROM channels"))
+async def admin_stats(exact: bool = False) -> Dict[str, Any]:
+    """
+    1 ta round-trip. Odatda stats_counters'dan (jadval hajmiga bog'liq emas);
+    exact=True — asosiy jadvallar bo'yicha bitta COUNT(*) FILTER query.
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        if exact:
+            row = await conn.fetchrow("""
+                WITH u AS (
+                    SELECT COUNT(*) AS total,
+                           COUNT(*) FILTER (WHERE verified) AS verified,
+                           COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE) AS today,
+                           COUNT(*) FILTER (WHERE verified AND created_at >= CURRENT_DATE) AS today_verified
+                    FROM users
+                ),
+                r AS (
+                    SELECT COUNT(*) AS total,
+                           COUNT(*) FILTER (WHERE credited) AS credited,
+                           COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE) AS today
+                    FROM referrals
+                )
+                SELECT u.total AS users_total,
+                       u.verified AS users_verified,
+                       u.today AS today_users,
+                       u.today_verified AS today_verified_created,
+                       r.total AS ref_total,
+                       r.credited AS ref_credited,
+                       r.today AS today_referrals,
+                       (SELECT COUNT(*) FROM prizes) AS prizes_count,
+                       (SELECT COUNT(*) FROM channels) AS channels_count,
+                       (SELECT value FROM settings WHERE key='contest_active') AS contest_active
+                FROM u, r
+            """)
+        else:
+            row = await conn.fetchrow("""
+                WITH c AS (
+                    SELECT name,
+                           SUM(value) AS total,
+                           COALESCE(SUM(value) FILTER (WHERE day = CURRENT_DATE), 0) AS today
+                    FROM stats_counters
+                    GROUP BY name
+                )
+                SELECT COALESCE((SELECT total FROM c WHERE name='users'), 0) AS users_total,
+                       COALESCE((SELECT total FROM c WHERE name='verified'), 0) AS users_verified,
+                       COALESCE((SELECT today FROM c WHERE name='users'), 0) AS today_users,
+                       COALESCE((SELECT today FROM c WHERE name='verified'), 0) AS today_verified_created,
+                       COALESCE((SELECT total FROM c WHERE name='referrals'), 0) AS ref_total,
+                       COALESCE((SELECT total FROM c WHERE name='credited'), 0) AS ref_credited,
+                       COALESCE((SELECT today FROM c WHERE name='referrals'), 0) AS today_referrals,
+                       (SELECT COUNT(*) FROM prizes) AS prizes_count,
+                       (SELECT COUNT(*) FROM channels) AS channels_count,
+                       (SELECT value FROM settings WHERE key='contest_active') AS contest_active
+            """)
 
-        contest_active = (await get_setting("contest_active", "1")) == "1"
+        users_total = int(row["users_total"])
+        users_verified = int(row["users_verified"])
+        ref_total = int(row["ref_total"])
+        ref_credited = int(row["ref_credited"])
 
         return {
             "users_total": users_total,
             "users_verified": users_verified,
-            "users_not_verified": users_not_verified,
+            "users_not_verified": users_total - users_verified,
             "ref_total": ref_total,
             "ref_credited": ref_credited,
-            "ref_not_credited": ref_not_credited,
-            "today_users": today_users,
-            "today_referrals": today_referrals,
-            "today_verified_created": today_verified_created,
-            "prizes_count": prizes_count,
-            "channels_count": channels_count,
-            "contest_active": contest_active,
+            "ref_not_credited": ref_total - ref_credited,
+            "today_users": int(row["today_users"]),
+            "today_referrals": int(row["today_referrals"]),
+            "today_verified_created": int(row["today_verified_created"]),
+            "prizes_count": int(row["prizes_count"]),
+            "channels_count": int(row["channels_count"]),
+            "contest_active": (row["contest_active"] or "1") == "1",
         }
 
 
-async def top_referrers(limit: int = 10) -> List[asyncpg.Record]:
-    return await get_top(limit)
+async def stats_rebuild() -> None:
+    """
+    stats_counters'ni users/referrals'dan qaytadan hisoblash (drift bo'lsa).
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            await conn.execute("LOCK TABLE stats_counters IN EXCLUSIVE MODE")
+            await conn.execute("DELETE FROM stats_counters")
+            await conn.execute(STATS_BACKFILL_SQL)
 
 
 async def get_top1_score() -> int:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         mx = await conn.fetchval("""
-            SELECT COALESCE(MAX(score), 0) AS mx
-            FROM (
-                SELECT u.user_id,
-                       COUNT(r.invited_user_id) AS score
-                FROM users u
-                LEFT JOIN referrals r
-                  ON r.referrer_id = u.user_id AND r.credited = TRUE
-                GROUP BY u.user_id
-            ) t
+            SELECT COALESCE(MAX(s.score), 0)
+            FROM referrer_scores s
+            JOIN users u ON u.user_id = s.user_id
         """)
         return int(mx or 0)
 
@@ -199,21 +220,43 @@ async def get_top1_score() -> int:
 # =========================
 # Settings
 # =========================
+# Process bo'yicha bitta snapshot: o'qish faqat xotiradan.
+# set_setting yozganda pg_notify(SETTINGS_CHANNEL) — barcha worker/replikalar
+# settings_reload qiladi (notify.py).
+SETTINGS_CHANNEL = "settings_changed"
+
+_settings: Optional[Dict[str, str]] = None
+
+
+async def settings_reload(_payload: Optional[str] = None) -> None:
+    global _settings
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        rows = await conn.fetch("SELECT key, value FROM settings")
+    _settings = {str(r["key"]): str(r["value"]) for r in rows}
+
+
 async def set_setting(key: str, value: str) -> None:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         await conn.execute("""
-            INSERT INTO settings(key, value)
-            VALUES($1, $2)
-            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
-        """, key, value)
+            WITH up AS (
+                INSERT INTO settings(key, value)
+                VALUES($1, $2)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                RETURNING key
+            )
+            SELECT pg_notify($3, key) FROM up
+        """, key, value, SETTINGS_CHANNEL)
+
+    if _settings is not None:
+        _settings[key] = value
 
 
 async def get_setting(key: str, default: str = "") -> str:
-    pool = await db_connect()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT value FROM settings WHERE key=$1", key)
-        return str(row["value"]) if row else default
+    if _settings is None:
+        await settings_reload()
+    return _settings.get(key, default)
 
 
 async def fix_referrals_duplicates() -> None:
@@ -222,7 +265,7 @@ async def fix_referrals_duplicates() -> None:
     lekin eski bazadan migrate bo'lsa ehtiyot uchun.
     """
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         await conn.execute("""
             DELETE FROM referrals r
             USING referrals r2
@@ -248,154 +291,166 @@ async def contest_start() -> None:
 # =========================
 async def count_users() -> int:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         return int(await conn.fetchval("SELECT COUNT(*) FROM users"))
 
 
-async def is_admin_db(user_id: int) -> bool:
+# Adminlar to'plami xotirada (settings kabi): admin_add / admin_del / reset_all_data
+# pg_notify(ADMINS_CHANNEL) qiladi — barcha worker/replikalar admins_reload qiladi.
+ADMINS_CHANNEL = "admins_changed"
+
+_admin_ids: Optional[Set[int]] = None
+
+
+async def admins_reload(_payload: Optional[str] = None) -> None:
+    global _admin_ids
     pool = await db_connect()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT user_id FROM admins WHERE user_id=$1", int(user_id))
-        return row is not None
+    async with _acquire(pool) as conn:
+        rows = await conn.fetch("SELECT user_id FROM admins")
+    _admin_ids = {int(r["user_id"]) for r in rows}
+
+
+async def is_admin_db(user_id: int) -> bool:
+    if _admin_ids is None:
+        await admins_reload()
+    return int(user_id) in _admin_ids
 
 
 async def admin_add(user_id: int) -> None:
     pool = await db_connect()
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO admins(user_id) VALUES($1) ON CONFLICT (user_id) DO NOTHING",
-            int(user_id),
-        )
+    async with _acquire(pool) as conn:
+        await conn.execute("""
+            WITH ins AS (
+                INSERT INTO admins(user_id) VALUES($1)
+                ON CONFLICT (user_id) DO NOTHING
+            )
+            SELECT pg_notify($2, $3)
+        """, int(user_id), ADMINS_CHANNEL, str(int(user_id)))
+
+    if _admin_ids is not None:
+        _admin_ids.add(int(user_id))
 
 
 async def admin_del(user_id: int) -> None:
     pool = await db_connect()
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM admins WHERE user_id=$1", int(user_id))
+    async with _acquire(pool) as conn:
+        await conn.execute("""
+            WITH del AS (
+                DELETE FROM admins WHERE user_id=$1
+            )
+            SELECT pg_notify($2, $3)
+        """, int(user_id), ADMINS_CHANNEL, str(int(user_id)))
+
+    if _admin_ids is not None:
+        _admin_ids.discard(int(user_id))
 
 
 async def admin_list() -> List[int]:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         rows = await conn.fetch("SELECT user_id FROM admins ORDER BY created_at ASC")
         return [int(r["user_id"]) for r in rows]
 
 
-async def upsert_user(user_id: int, username: str, first_name: str, referrer_id: Optional[int]) -> None:
+async def register_user(
+    user_id: int, username: str, first_name: str, referrer_id: Optional[int]
+) -> Tuple[bool, bool]:
     """
-    Webhookda eng ko'p uriladigan joy.
-    Oldingi variant (SELECT -> INSERT/UPDATE) race + 2ta query edi.
-    Bu variant 1 ta UPSERT query: tezroq + xavfsizroq.
-
-    referrer_id faqat users.referrer_id NULL bo'lsa qo'yiladi.
+    /start: users upsert + referrals yozuvi bitta query'da.
+    O'zini o'zi taklif qilish SQL ichida tashlanadi. users.referrer_id ham,
+    referrals ham "birinchisi qoladi" (COALESCE / ON CONFLICT DO NOTHING).
+    /start bosgan user broadcast uchun yana "yetib boradigan" bo'ladi.
+    Qaytaradi: (yangi user'mi, verified'mi).
     """
-    if referrer_id == user_id:
-        referrer_id = None
-
     pool = await db_connect()
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users(user_id, username, first_name, referrer_id, verified)
-            VALUES($1, $2, $3, $4, FALSE)
-            ON CONFLICT (user_id) DO UPDATE
-            SET username = EXCLUDED.username,
-                first_name = EXCLUDED.first_name,
-                referrer_id = COALESCE(users.referrer_id, EXCLUDED.referrer_id)
+    async with _acquire(pool) as conn:
+        row = await conn.fetchrow(f"""
+            WITH ref AS (
+                SELECT CASE WHEN $4::bigint > 0 AND $4::bigint <> $1::bigint THEN $4::bigint END AS referrer_id
+            ),
+            up AS (
+                INSERT INTO users(user_id, username, first_name, referrer_id, verified)
+                SELECT $1, $2, $3, ref.referrer_id, FALSE FROM ref
+                ON CONFLICT (user_id) DO UPDATE
+                SET username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name,
+                    referrer_id = COALESCE(users.referrer_id, EXCLUDED.referrer_id),
+                    blocked_at = NULL
+                RETURNING created_at, verified, (xmax = 0) AS inserted
+            ),
+            ucnt AS ({_bump_counter("users", "up WHERE inserted")}),
+            ins AS (
+                INSERT INTO referrals(invited_user_id, referrer_id, credited)
+                SELECT $1, ref.referrer_id, FALSE FROM ref
+                WHERE ref.referrer_id IS NOT NULL
+                ON CONFLICT (invited_user_id) DO NOTHING
+                RETURNING created_at
+            ),
+            rcnt AS ({_bump_counter("referrals", "ins")})
+            SELECT inserted, verified FROM up
         """, int(user_id), username, first_name, referrer_id)
-
-
-async def set_verified(user_id: int, verified: bool) -> None:
-    pool = await db_connect()
-    async with pool.acquire() as conn:
-        if verified:
-            await conn.execute("""
-                UPDATE users
-                SET verified=TRUE, verified_at=NOW()
-                WHERE user_id=$1
-            """, int(user_id))
-        else:
-            await conn.execute("""
-                UPDATE users
-                SET verified=FALSE, verified_at=NULL
-                WHERE user_id=$1
-            """, int(user_id))
-
-
-async def is_verified(user_id: int) -> bool:
-    pool = await db_connect()
-    async with pool.acquire() as conn:
-        v = await conn.fetchval("SELECT verified FROM users WHERE user_id=$1", int(user_id))
-        return bool(v) if v is not None else False
+    return bool(row["inserted"]), bool(row["verified"])
 
 
 async def get_user(user_id: int) -> Optional[asyncpg.Record]:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         return await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", int(user_id))
 
 
-async def get_all_user_ids() -> List[int]:
-    pool = await db_connect()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id FROM users")
-        return [int(r["user_id"]) for r in rows]
-
-
 # =========================
 # Referrals / Scoring
 # =========================
-async def ensure_referral(invited_user_id: int, referrer_id: int) -> None:
-    """
-    invited_user_id PRIMARY KEY bo'lgani uchun ON CONFLICT DO NOTHING idempotent.
+async def verify_and_credit(user_id: int) -> Tuple[bool, Optional[int], Optional[int]]:
     """
-    if invited_user_id == referrer_id:
-        return
-
-    pool = await db_connect()
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO referrals(invited_user_id, referrer_id, credited)
-            VALUES($1, $2, FALSE)
-            ON CONFLICT (invited_user_id) DO NOTHING
-        """, int(invited_user_id), int(referrer_id))
-
-
-async def credit_referrer_if_needed(invited_user_id: int) -> Optional[int]:
-    """
-    Verified bo'lganda 1 martagina credited=TRUE bo'ladi.
-    FOR UPDATE -> retry/parallel update kelganda ham dublikat credit bo'lmaydi.
+    confirm_sub uchun bitta round-trip: verified=FALSE -> TRUE, o'sha
+    o'tishda kutilayotgan referral credited bo'ladi, referrer_scores va
+    hisoblagichlar yangilanadi.
+    Qaytaradi: (hozir verified bo'ldimi, referrer_id, referrer'ning yangi bali).
+
+    Dublikat credit bo'lmaydi: users qatori "WHERE verified=FALSE" bilan
+    yangilanadi — parallel tranzaksiya row lock'ni kutadi, keyin shartni qayta
+    tekshiradi va hech narsa qilmaydi; referral ham faqat credited=FALSE bo'lsa.
     """
     pool = await db_connect()
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            verified = await conn.fetchval(
-                "SELECT verified FROM users WHERE user_id=$1",
-                int(invited_user_id),
-            )
-            if not verified:
-                return None
-
-            r = await conn.fetchrow("""
-                SELECT referrer_id, credited
-                FROM referrals
-                WHERE invited_user_id=$1
-                FOR UPDATE
-            """, int(invited_user_id))
-
-            if not r or bool(r["credited"]) is True:
-                return None
-
-            referrer_id = int(r["referrer_id"])
-            await conn.execute(
-                "UPDATE referrals SET credited=TRUE WHERE invited_user_id=$1",
-                int(invited_user_id),
+    async with _acquire(pool) as conn:
+        row = await conn.fetchrow(f"""
+            WITH v AS (
+                UPDATE users
+                SET verified=TRUE, verified_at=NOW()
+                WHERE user_id=$1 AND verified=FALSE
+                RETURNING user_id, created_at
+            ),
+            vcnt AS ({_bump_counter("verified", "v")}),
+            cr AS (
+                UPDATE referrals r
+                SET credited=TRUE
+                FROM v
+                WHERE r.invited_user_id = v.user_id AND r.credited=FALSE
+                RETURNING r.referrer_id, r.created_at
+            ),
+            ccnt AS ({_bump_counter("credited", "cr")}),
+            sc AS (
+                INSERT INTO referrer_scores(user_id, score, first_credit_at, created_at)
+                SELECT cr.referrer_id, 1, NOW(),
+                       COALESCE((SELECT created_at FROM users WHERE user_id=cr.referrer_id), NOW())
+                FROM cr
+                ON CONFLICT (user_id) DO UPDATE SET score = referrer_scores.score + 1
+                RETURNING user_id, score
             )
-            return referrer_id
+            SELECT EXISTS (SELECT 1 FROM v) AS verified_now, sc.user_id AS referrer_id, sc.score
+            FROM (SELECT 1) one
+            LEFT JOIN sc ON TRUE
+        """, int(user_id))
+
+    referrer_id = int(row["referrer_id"]) if row["referrer_id"] is not None else None
+    score = int(row["score"]) if row["score"] is not None else None
+    return bool(row["verified_now"]), referrer_id, score
 
 
 async def get_stats_for_user(user_id: int) -> Tuple[int, int, int]:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         row = await conn.fetchrow("""
             SELECT
               COUNT(*)::int AS total,
@@ -409,49 +464,136 @@ async def get_stats_for_user(user_id: int) -> Tuple[int, int, int]:
 
 
 async def get_top(limit: int = 10) -> List[asyncpg.Record]:
+    """
+    referrer_scores indeksi bo'yicha. Ball egalari limitga yetmasa —
+    oldingidek 0 balli user'lar (created_at bo'yicha) bilan to'ldiriladi;
+    ikkinchi qism faqat kerak bo'lsagina bajariladi.
+    """
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         return await conn.fetch("""
-            SELECT u.user_id, u.first_name, u.username,
-                   COUNT(r.invited_user_id)::int AS score
-            FROM users u
-            LEFT JOIN referrals r
-              ON r.referrer_id = u.user_id AND r.credited = TRUE
-            GROUP BY u.user_id
-            ORDER BY score DESC, u.created_at ASC
+            (
+                SELECT u.user_id, u.first_name, u.username, s.score
+                FROM referrer_scores s
+                JOIN users u ON u.user_id = s.user_id
+                WHERE s.score > 0
+                ORDER BY s.score DESC, u.created_at ASC
+                LIMIT $1
+            )
+            UNION ALL
+            (
+                SELECT u.user_id, u.first_name, u.username, 0 AS score
+                FROM users u
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM referrer_scores s
+                    WHERE s.user_id = u.user_id AND s.score > 0
+                )
+                ORDER BY u.created_at ASC
+                LIMIT $1
+            )
             LIMIT $1
         """, int(limit))
 
 
 async def get_rank(user_id: int) -> Optional[int]:
+    """
+    DENSE_RANK bilan bir xil (faqat users): 1 + o'zidan katta bo'lgan turli ballar soni.
+    """
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         row = await conn.fetchrow("""
-            WITH scores AS (
-                SELECT u.user_id AS uid,
-                       COUNT(r.invited_user_id)::int AS score
-                FROM users u
-                LEFT JOIN referrals r
-                  ON r.referrer_id = u.user_id AND r.credited = TRUE
-                GROUP BY u.user_id
-            ),
-            ranked AS (
-                SELECT uid,
-                       score,
-                       DENSE_RANK() OVER (ORDER BY score DESC) AS rnk
-                FROM scores
-            )
-            SELECT rnk FROM ranked WHERE uid=$1
+            SELECT 1 + (
+                SELECT COUNT(DISTINCT rs.score)
+                FROM referrer_scores rs
+                JOIN users ru ON ru.user_id = rs.user_id
+                WHERE rs.score > COALESCE(s.score, 0)
+            ) AS rnk
+            FROM users u
+            LEFT JOIN referrer_scores s ON s.user_id = u.user_id
+            WHERE u.user_id = $1
         """, int(user_id))
         return int(row["rnk"]) if row else None
 
 
+async def referrer_scores_all() -> List[asyncpg.Record]:
+    """
+    In-memory reyting (leaderboard.py) uchun: barcha ball egalari.
+    Teng ballarda tartib — users.created_at (user bo'lmasa referrer_scores'niki),
+    referrer_meta va get_top bilan bir xil.
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        return await conn.fetch("""
+            SELECT s.user_id, s.score, COALESCE(u.created_at, s.created_at) AS created_at,
+                   (u.user_id IS NOT NULL) AS in_users
+            FROM referrer_scores s
+            LEFT JOIN users u ON u.user_id = s.user_id
+            WHERE s.score > 0
+        """)
+
+
+async def referrer_meta(user_id: int) -> asyncpg.Record:
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        return await conn.fetchrow("""
+            SELECT COALESCE(u.created_at, s.created_at, NOW()) AS created_at,
+                   (u.user_id IS NOT NULL) AS in_users
+            FROM (SELECT $1::bigint AS uid) q
+            LEFT JOIN users u ON u.user_id = q.uid
+            LEFT JOIN referrer_scores s ON s.user_id = q.uid
+        """, int(user_id))
+
+
+async def user_names(user_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+    """
+    TOP uchun: user_id -> (first_name, username), bitta query.
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        rows = await conn.fetch("""
+            SELECT user_id, first_name, username
+            FROM users
+            WHERE user_id = ANY($1::bigint[])
+        """, [int(x) for x in user_ids])
+    return {int(r["user_id"]): (r["first_name"] or "", r["username"] or "") for r in rows}
+
+
+async def referrer_scores_summary() -> Tuple[int, int, int, int]:
+    """
+    (ball egalari soni, ballar yig'indisi, max ball, ulardan users'dagilar soni) —
+    reyting mosligini tekshirish uchun. Oxirgisi ball egasi keyinroq /start
+    bosganini ham ushlaydi.
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        row = await conn.fetchrow("""
+            SELECT COUNT(*) AS n, COALESCE(SUM(s.score), 0) AS total,
+                   COALESCE(MAX(s.score), 0) AS mx, COUNT(u.user_id) AS in_users
+            FROM referrer_scores s
+            LEFT JOIN users u ON u.user_id = s.user_id
+            WHERE s.score > 0
+        """)
+        return int(row["n"]), int(row["total"]), int(row["mx"]), int(row["in_users"])
+
+
+async def rebuild_referrer_scores() -> None:
+    """
+    referrer_scores'ni referrals'dan qaytadan hisoblash (backfill / drift bo'lsa).
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        async with conn.transaction():
+            await conn.execute("LOCK TABLE referrer_scores IN EXCLUSIVE MODE")
+            await conn.execute("DELETE FROM referrer_scores")
+            await conn.execute(SCORES_BACKFILL_SQL)
+
+
 # =========================
 # Prizes
 # =========================
 async def prize_add(place: int, title: str, description: str = "") -> None:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         await conn.execute("""
             INSERT INTO prizes(place, title, description)
             VALUES($1, $2, $3)
@@ -460,13 +602,13 @@ async def prize_add(place: int, title: str, description: str = "") -> None:
 
 async def prize_del(prize_id: int) -> None:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         await conn.execute("DELETE FROM prizes WHERE id=$1", int(prize_id))
 
 
 async def prize_list() -> List[asyncpg.Record]:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         return await conn.fetch("SELECT * FROM prizes ORDER BY place ASC, id ASC")
 
 
@@ -494,13 +636,16 @@ async def reset_all_data(
     reset_settings: bool = False,
 ) -> None:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         async with conn.transaction():
             if delete_referrals:
                 await conn.execute("TRUNCATE TABLE referrals")
+                await conn.execute("TRUNCATE TABLE referrer_scores")
+                await conn.execute("DELETE FROM stats_counters WHERE name IN ('referrals', 'credited')")
 
             if delete_users:
                 await conn.execute("TRUNCATE TABLE users")
+                await conn.execute("DELETE FROM stats_counters WHERE name IN ('users', 'verified')")
 
             if delete_prizes:
                 await conn.execute("TRUNCATE TABLE prizes RESTART IDENTITY")
@@ -510,6 +655,7 @@ async def reset_all_data(
                     await _keep_only_env_admins(conn)
                 else:
                     await conn.execute("TRUNCATE TABLE admins")
+                await conn.execute("SELECT pg_notify($1, '*')", ADMINS_CHANNEL)
 
             if reset_settings:
                 await conn.execute("TRUNCATE TABLE settings")
@@ -521,6 +667,12 @@ async def reset_all_data(
                       ('ad_btn_url','')
                     ON CONFLICT (key) DO NOTHING;
                 """)
+                await conn.execute("SELECT pg_notify($1, '*')", SETTINGS_CHANNEL)
+
+    if reset_settings:
+        await settings_reload()
+    if delete_admins:
+        await admins_reload()
 
 
 async def contest_finish_and_clear_users(
@@ -543,27 +695,341 @@ async def contest_finish_and_clear_users(
 # =========================
 # Channels
 # =========================
-async def channel_add(username: str) -> None:
+# subscriptions.py kanallarni xotirada saqlaydi; o'zgarishda pg_notify(CHANNELS_CHANNEL)
+CHANNELS_CHANNEL = "channels_changed"
+
+
+async def channel_add(username: str, chat_id: Optional[int] = None) -> None:
     username = username.strip()
     if not username:
         return
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         await conn.execute("""
-            INSERT INTO channels(username)
-            VALUES($1)
-            ON CONFLICT (username) DO NOTHING
-        """, username)
+            WITH ins AS (
+                INSERT INTO channels(username, chat_id)
+                VALUES($1, $2)
+                ON CONFLICT (username) DO UPDATE
+                SET chat_id = COALESCE(EXCLUDED.chat_id, channels.chat_id)
+            )
+            SELECT pg_notify($3, $1)
+        """, username, chat_id, CHANNELS_CHANNEL)
 
 
 async def channel_del(username: str) -> None:
     pool = await db_connect()
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM channels WHERE username=$1", username.strip())
+    async with _acquire(pool) as conn:
+        await conn.execute("""
+            WITH del AS (
+                DELETE FROM channels WHERE username=$1
+            )
+            SELECT pg_notify($2, $1)
+        """, username.strip(), CHANNELS_CHANNEL)
+
+
+async def channel_set_chat_id(username: str, chat_id: int) -> None:
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        await conn.execute("""
+            WITH upd AS (
+                UPDATE channels SET chat_id=$2 WHERE username=$1
+            )
+            SELECT pg_notify($3, $1)
+        """, username, int(chat_id), CHANNELS_CHANNEL)
+
+
+async def channel_rows() -> List[asyncpg.Record]:
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        return await conn.fetch("SELECT username, chat_id FROM channels ORDER BY id ASC")
+
+
+# =========================
+# Channel members (chat_member push)
+# =========================
+async def channel_member_set(
+    channel_id: int, user_id: int, status: str, at: Optional[datetime] = None
+) -> None:
+    """
+    at — chat_member update vaqti; eskiroq update yangisini bosib ketmaydi
+    (webhook'lar tartibsiz kelishi mumkin). None — hozir (API fallback).
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        await conn.execute("""
+            INSERT INTO channel_members(user_id, channel_id, status, updated_at)
+            VALUES($1, $2, $3, COALESCE($4::timestamptz, NOW()))
+            ON CONFLICT (user_id, channel_id) DO UPDATE
+            SET status = EXCLUDED.status, updated_at = EXCLUDED.updated_at
+            WHERE channel_members.updated_at <= EXCLUDED.updated_at
+        """, int(user_id), int(channel_id), status, at)
+
+
+async def channel_member_statuses(user_id: int, channel_ids: List[int]) -> Dict[int, str]:
+    """
+    Barcha kanallar bo'yicha bitta PK lookup. Yozuv yo'q kanal — natijada yo'q.
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        rows = await conn.fetch("""
+            SELECT channel_id, status
+            FROM channel_members
+            WHERE user_id=$1 AND channel_id = ANY($2::bigint[])
+        """, int(user_id), [int(x) for x in channel_ids])
+    return {int(r["channel_id"]): str(r["status"]) for r in rows}
 
 
 async def channel_list() -> List[str]:
     pool = await db_connect()
-    async with pool.acquire() as conn:
+    async with _acquire(pool) as conn:
         rows = await conn.fetch("SELECT username FROM channels ORDER BY id ASC")
         return [str(r["username"]) for r in rows]
+
+
+# =========================
+# Broadcast jobs
+# =========================
+# yangi job / bekor qilish -> leader'dagi broadcast runner uyg'onadi
+BROADCAST_CHANNEL = "broadcast_changed"
+
+_BROADCAST_COLS = """
+    id, status, created_by, src_chat_id, src_message_id, src_text, src_caption,
+    extra_text, cursor_user_id, total, sent, failed, blocked,
+    seg_verified, seg_since, seg_top, seg_include_blocked,
+    rendered, payload_text, reply_markup, media_type, media_file_id,
+    errors, last_error, created_at, started_at, finished_at,
+    EXTRACT(EPOCH FROM (COALESCE(finished_at, NOW()) - started_at)) AS elapsed
+"""
+
+
+def _segment_where(segment: Dict[str, Any], params: List[Any]) -> str:
+    """
+    Segment -> WHERE shartlari. Shartlar literal qo'shiladi (param bilan
+    "$n OR ..." emas) — shunda partial index'lar generic plan'da ham ishlatiladi.
+    params'ga qiymatlar qo'shiladi.
+      verified        — faqat verified
+      since           — users.created_at >= since
+      top             — referrer_scores bo'yicha TOP-N referrer
+      include_blocked — bloklaganlar ham (odatda yo'q)
+    """
+    conds = []
+    if not segment.get("include_blocked"):
+        conds.append("blocked_at IS NULL")
+    if segment.get("verified"):
+        conds.append("verified")
+    if segment.get("since") is not None:
+        params.append(segment["since"])
+        conds.append(f"created_at >= ${len(params)}")
+    if segment.get("top"):
+        params.append(int(segment["top"]))
+        conds.append(f"""user_id IN (
+            SELECT s.user_id FROM referrer_scores s
+            JOIN users ru ON ru.user_id = s.user_id
+            WHERE s.score > 0
+            ORDER BY s.score DESC, ru.created_at ASC
+            LIMIT ${len(params)}
+        )""")
+    return " AND ".join(conds) if conds else "TRUE"
+
+
+def job_segment(job: asyncpg.Record) -> Dict[str, Any]:
+    return {
+        "verified": bool(job["seg_verified"]),
+        "since": job["seg_since"],
+        "top": job["seg_top"],
+        "include_blocked": bool(job["seg_include_blocked"]),
+    }
+
+
+async def broadcast_create(
+    *,
+    created_by: int,
+    src_chat_id: int,
+    src_message_id: int,
+    src_text: Optional[str],
+    src_caption: Optional[str],
+    extra_text: str,
+    segment: Optional[Dict[str, Any]] = None,
+    payload: Optional[Dict[str, Any]] = None,
+) -> int:
+    """
+    payload — broadcast.compile_payload natijasi (payload_text, reply_markup,
+    media_type, media_file_id). None bo'lsa runner job boshida tayyorlaydi.
+    """
+    segment = segment or {}
+    params: List[Any] = [
+        int(created_by), int(src_chat_id), int(src_message_id),
+        src_text, src_caption, extra_text or "", BROADCAST_CHANNEL,
+        bool(segment.get("verified")), segment.get("since"),
+        int(segment["top"]) if segment.get("top") else None,
+        bool(segment.get("include_blocked")),
+        payload is not None,
+    ]
+    payload = payload or {}
+    params += [
+        payload.get("payload_text"), payload.get("reply_markup"),
+        payload.get("media_type"), payload.get("media_file_id"),
+    ]
+    where = _segment_where(segment, params)
+
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        return int(await conn.fetchval(f"""
+            WITH job AS (
+                INSERT INTO broadcast_jobs(
+                    created_by, src_chat_id, src_message_id, src_text, src_caption, extra_text,
+                    seg_verified, seg_since, seg_top, seg_include_blocked,
+                    rendered, payload_text, reply_markup, media_type, media_file_id, total
+                )
+                VALUES($1, $2, $3, $4, $5, $6, $8, $9, $10, $11, $12, $13, $14, $15, $16,
+                       (SELECT COUNT(*) FROM users WHERE {where}))
+                RETURNING id
+            )
+            SELECT id, pg_notify($7, id::text) FROM job
+        """, *params))
+
+
+async def broadcast_next() -> Optional[asyncpg.Record]:
+    """
+    Eng eski tugallanmagan job'ni 'running' qiladi (restart'dan keyin
+    'running' qolgani ham shu yerda qaytadi — cursor'dan davom etadi).
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        return await conn.fetchrow(f"""
+            UPDATE broadcast_jobs
+            SET status='running', started_at=COALESCE(started_at, NOW())
+            WHERE id = (
+                SELECT id FROM broadcast_jobs
+                WHERE status IN ('pending', 'running')
+                ORDER BY id
+                LIMIT 1
+            )
+            RETURNING {_BROADCAST_COLS}
+        """)
+
+
+async def broadcast_recipients(
+    after_user_id: int, limit: int, segment: Optional[Dict[str, Any]] = None
+) -> List[int]:
+    # keyset: user_id index bo'yicha, OFFSET'siz
+    params: List[Any] = [int(after_user_id), int(limit)]
+    where = _segment_where(segment or {}, params)
+
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        rows = await conn.fetch(f"""
+            SELECT user_id FROM users
+            WHERE user_id > $1 AND {where}
+            ORDER BY user_id
+            LIMIT $2
+        """, *params)
+    return [int(r["user_id"]) for r in rows]
+
+
+async def iter_recipients(
+    segment: Optional[Dict[str, Any]] = None, *, after_user_id: int = 0, chunk: int = 500
+) -> AsyncIterator[List[int]]:
+    """
+    Segment user'larini user_id tartibida chunk-chunk beradi — xotirada
+    bir vaqtda faqat bitta chunk. Har chunk alohida qisqa query: soatlab
+    ochiq turadigan server-side cursor (va uning tranzaksiyasi/snapshot'i,
+    band connection'i) kerak emas, restart'dan keyin esa oxirgi user_id'dan
+    davom etish mumkin.
+    """
+    after = int(after_user_id)
+    while True:
+        ids = await broadcast_recipients(after, chunk, segment)
+        if not ids:
+            return
+        yield ids
+        after = ids[-1]
+
+
+async def broadcast_progress(
+    job_id: int, cursor_user_id: int, sent: int, failed: int, blocked: List[int]
+) -> str:
+    """
+    Bir chunk tugagach: cursor/hisoblagichlar + bloklagan user'larni belgilash,
+    bitta query. Qaytaradi: job status (bekor qilingan bo'lsa — 'cancelled').
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        status = await conn.fetchval("""
+            WITH blk AS (
+                UPDATE users SET blocked_at=NOW()
+                WHERE user_id = ANY($5::bigint[]) AND blocked_at IS NULL
+            )
+            UPDATE broadcast_jobs
+            SET cursor_user_id=$2, sent=sent+$3, failed=failed+$4,
+                blocked=blocked+cardinality($5::bigint[]), errors=0, updated_at=NOW()
+            WHERE id=$1
+            RETURNING status
+        """, int(job_id), int(cursor_user_id), int(sent), int(failed), [int(x) for x in blocked])
+    return str(status or "")
+
+
+async def broadcast_finish(job_id: int) -> None:
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        await conn.execute("""
+            UPDATE broadcast_jobs
+            SET status='done', finished_at=NOW()
+            WHERE id=$1 AND status='running'
+        """, int(job_id))
+
+
+async def broadcast_error(job_id: int, error: str, max_errors: int) -> str:
+    """
+    Runner job'da xato bilan to'xtadi. Ketma-ket max_errors ta xatodan keyin
+    job 'failed' bo'ladi — broadcast_next uni boshqa olmaydi.
+    Qaytaradi: job status.
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        status = await conn.fetchval("""
+            UPDATE broadcast_jobs
+            SET errors=errors+1, last_error=$2, updated_at=NOW(),
+                status=CASE WHEN errors+1 >= $3 THEN 'failed' ELSE status END,
+                finished_at=CASE WHEN errors+1 >= $3 THEN NOW() ELSE finished_at END
+            WHERE id=$1 AND status='running'
+            RETURNING status
+        """, int(job_id), error[:1000], int(max_errors))
+    return str(status or "")
+
+
+async def broadcast_cancel(job_id: Optional[int] = None) -> Optional[int]:
+    """
+    job_id=None — eng oxirgi tugallanmagan job. Qaytaradi: bekor qilingan id.
+    """
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        v = await conn.fetchval("""
+            WITH c AS (
+                UPDATE broadcast_jobs
+                SET status='cancelled', finished_at=NOW()
+                WHERE id = (
+                    SELECT id FROM broadcast_jobs
+                    WHERE status IN ('pending', 'running')
+                      AND ($1::bigint IS NULL OR id = $1)
+                    ORDER BY id DESC
+                    LIMIT 1
+                )
+                RETURNING id
+            )
+            SELECT id, pg_notify($2, id::text) FROM c
+        """, job_id, BROADCAST_CHANNEL)
+    return int(v) if v is not None else None
+
+
+async def broadcast_get(job_id: Optional[int] = None) -> Optional[asyncpg.Record]:
+    # job_id=None — eng oxirgisi
+    pool = await db_connect()
+    async with _acquire(pool) as conn:
+        return await conn.fetchrow(f"""
+            SELECT {_BROADCAST_COLS}
+            FROM broadcast_jobs
+            WHERE ($1::bigint IS NULL OR id = $1)
+            ORDER BY id DESC
+            LIMIT 1
+        """, job_id)
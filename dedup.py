@@ -0,0 +1,65 @@
+import re
+from typing import Any, Dict, List, Optional
+
+# Telegram update_id ni doim birinchi kalit qilib yuboradi: {"update_id":123,...
+_UPDATE_ID_HEAD = re.compile(rb'\s*\{\s*"update_id"\s*:\s*(\d+)\s*[,}]')
+
+
+def peek_update_id(body: bytes) -> Optional[int]:
+    """
+    Body'ni to'liq parse qilmasdan update_id ni o'qish (dedup uchun).
+    Topilmasa None — u holda validate'dan keyin tekshiriladi.
+    """
+    m = _UPDATE_ID_HEAD.match(body)
+    return int(m.group(1)) if m else None
+
+
+class UpdateDedup:
+    """
+    Oxirgi N ta update_id oynasi: ring buffer + dict (update_id -> ring slot).
+    Telegram sekin webhookka bir xil update_id ni qayta yuboradi —
+    ular Update.model_validate'dan oldin tashlanadi.
+
+    seen/add/forget — O(1), xotira window bilan cheklangan.
+    """
+
+    def __init__(self, window: int) -> None:
+        self._window = max(1, int(window))
+        self._ring: List[Optional[int]] = [None] * self._window
+        self._pos = 0
+        self._ids: Dict[int, int] = {}
+        self.duplicates = 0
+
+    def seen(self, update_id: int) -> bool:
+        if update_id in self._ids:
+            self.duplicates += 1
+            return True
+        return False
+
+    def add(self, update_id: int) -> None:
+        if update_id in self._ids:
+            return
+        old = self._ring[self._pos]
+        if old is not None:
+            self._ids.pop(old, None)
+        self._ring[self._pos] = update_id
+        self._ids[update_id] = self._pos
+        self._pos = (self._pos + 1) % self._window
+
+    def forget(self, update_id: int) -> None:
+        """
+        Update qayta ishlanmagan bo'lsa (xato / navbat to'la) —
+        Telegram'ning qayta yuborgani qabul qilinsin.
+        """
+        # slot ham bo'shatiladi — aks holda qayta add() dan keyin eski slot
+        # ustiga yozilganda yangi (tirik) yozuv ham o'chib ketardi
+        pos = self._ids.pop(update_id, None)
+        if pos is not None:
+            self._ring[pos] = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window": self._window,
+            "size": len(self._ids),
+            "duplicates": self.duplicates,
+        }
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram.types import Update
+
+log = logging.getLogger(__name__)
+
+FeedFn = Callable[[Update], Awaitable[Any]]
+
+
+def update_user_id(update: Update) -> Optional[int]:
+    try:
+        event = update.event
+    except Exception:
+        return None
+
+    user = getattr(event, "from_user", None) or getattr(event, "user", None)
+    return int(user.id) if user is not None else None
+
+
+def update_key(update: Update) -> int:
+    """
+    Update kimga tegishli: avval from_user, bo'lmasa chat, oxiri update_id.
+    Bitta user'ning update'lari doim bitta shard'ga tushadi.
+    """
+    uid = update_user_id(update)
+    if uid is not None:
+        return uid
+
+    try:
+        chat = getattr(update.event, "chat", None)
+    except Exception:
+        chat = None
+    if chat is not None:
+        return int(chat.id)
+
+    return int(update.update_id)
+
+
+class UpdateQueue:
+    """
+    Webhook update'larni cheklangan navbatga qo'yadi va worker'lar orqali
+    Dispatcher'ga uzatadi. Webhook DB / getChatMember'ni kutmasdan 200 qaytaradi.
+
+    Navbat user bo'yicha shard'larga bo'lingan, har shard'da bitta worker:
+    bitta user'ning update'lari qat'iy ketma-ket (join_flow -> confirm_sub
+    poyga qilmaydi), turli user'lar esa parallel ishlaydi.
+    """
+
+    def __init__(self, feed: FeedFn, *, workers: int, maxsize: int) -> None:
+        self._feed = feed
+        shards = max(1, int(workers))
+        per_shard = max(1, -(-int(maxsize) // shards))  # ceil
+        self._queues: List["asyncio.Queue[Update]"] = [
+            asyncio.Queue(maxsize=per_shard) for _ in range(shards)
+        ]
+        self._tasks: List[asyncio.Task] = []
+
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.busy = 0
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        for i, q in enumerate(self._queues):
+            self._tasks.append(asyncio.create_task(self._worker(q), name=f"update-worker-{i}"))
+
+    def submit(self, update: Update) -> bool:
+        """
+        Shard navbati to'la bo'lsa False — webhook Telegram'ga qayta yuborishni aytadi.
+        """
+        q = self._queues[update_key(update) % len(self._queues)]
+        try:
+            q.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    async def _worker(self, q: "asyncio.Queue[Update]") -> None:
+        while True:
+            update = await q.get()
+            self.busy += 1
+            try:
+                await self._feed(update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                log.exception("update %s qayta ishlanmadi", update.update_id)
+            finally:
+                self.busy -= 1
+                q.task_done()
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    async def stop(self, *, drain: bool = True, timeout: float = 10.0) -> None:
+        if drain and self._tasks:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(q.join() for q in self._queues)),
+                    timeout=timeout,
+                )
+            except asyncio.TimeoutError:
+                log.warning("drain timeout: %s ta update navbatda qoldi", self.depth())
+
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+        self.dropped += self.depth()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self._tasks),
+            "shards": len(self._queues),
+            "depth": self.depth(),
+            "max_shard_depth": max(q.qsize() for q in self._queues),
+            "maxsize": sum(q.maxsize for q in self._queues),
+            "busy": self.busy,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
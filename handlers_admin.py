@@ -1,24 +1,29 @@
 from __future__ import annotations
 
-import asyncio
+import html
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
 from aiogram import Router
 from aiogram.filters import Command
 from aiogram.types import Message
 
-from config import ENV_ADMIN_IDS
 from db import (
     set_setting,
     admin_list, admin_add, admin_del,
     prize_add, prize_del, prize_list,
-    get_all_user_ids,
+    broadcast_create, broadcast_get, broadcast_cancel, job_segment,
     contest_end,
     contest_finish_and_clear_users,
     reset_all_data,
     channel_add, channel_del, channel_list,
-    admin_stats, top_referrers,
-    is_admin_db,
+    admin_stats, stats_rebuild,
+    rebuild_referrer_scores,
 )
-from utils import merge_text_with_ad
+from broadcast import compile_payload
+from leaderboard import get_top, leaderboard_load
+from subscriptions import channels_reload, resolve_chat_id
+from utils import is_admin, is_env_admin
 
 router_admin = Router()
 
@@ -27,21 +32,6 @@ router_admin = Router()
 # Helpers
 # =========================
 
-def _env_admin_ids_set() -> set[int]:
-    try:
-        return {int(x) for x in ENV_ADMIN_IDS}
-    except TypeError:
-        return set()
-
-
-async def is_admin(user_id: int) -> bool:
-    # 1) env adminlar
-    if int(user_id) in _env_admin_ids_set():
-        return True
-    # 2) db adminlar (xohlasang olib tashlaysan)
-    return bool(await is_admin_db(int(user_id)))
-
-
 def _split_args(text: str) -> list[str]:
     return (text or "").strip().split()
 
@@ -79,7 +69,10 @@ async def cmd_stats(message: Message):
     if not await _reply_admin_only(message):
         return
 
-    s = await admin_stats()
+    # /stats exact — hisoblagichlar emas, jadvallarning o'zidan sanash
+    exact = "exact" in {p.lower() for p in _split_args(message.text)[1:]}
+
+    s = await admin_stats(exact=exact)
     status = "ACTIVE" if s["contest_active"] else "STOPPED"
     channels_line = (
         str(s["channels_count"]) if s["channels_count"] is not None else "channels table yo'q"
@@ -107,12 +100,31 @@ async def cmd_stats(message: Message):
     await message.answer(text)
 
 
+@router_admin.message(Command("stats_rebuild"))
+async def cmd_stats_rebuild(message: Message):
+    if not await _reply_admin_only(message):
+        return
+
+    await stats_rebuild()
+    await message.answer("Statistika hisoblagichlari qayta hisoblandi.")
+
+
+@router_admin.message(Command("scores_rebuild"))
+async def cmd_scores_rebuild(message: Message):
+    if not await _reply_admin_only(message):
+        return
+
+    await rebuild_referrer_scores()
+    await leaderboard_load()
+    await message.answer("Reyting (referrer_scores) referrals'dan qayta hisoblandi.")
+
+
 @router_admin.message(Command("top"))
 async def cmd_admin_top(message: Message):
     if not await _reply_admin_only(message):
         return
 
-    rows = await top_referrers(20)
+    rows = await get_top(20)
     if not rows:
         await message.answer("Top yo'q.")
         return
@@ -157,6 +169,7 @@ async def cmd_finish(message: Message):
         clear_admins=False,
         keep_env_admins=True,
     )
+    await leaderboard_load()
     await message.answer("Konkurs tugatildi va users+referrals tozalandi.")
 
 
@@ -183,6 +196,7 @@ async def cmd_reset_all(message: Message):
         keep_env_admins=True,
         reset_settings=reset_settings_flag,
     )
+    await leaderboard_load()
 
     msg = ["Reset done:"]
     msg.append("- users: deleted")
@@ -237,7 +251,7 @@ async def cmd_admin_del(message: Message):
         return
 
     aid = int(parts[1])
-    if aid in _env_admin_ids_set():
+    if is_env_admin(aid):
         await message.answer("Bu admin .env orqali berilgan, DB dan o‘chirilmadi.")
         return
 
@@ -300,60 +314,154 @@ async def cmd_prize_del(message: Message):
 # Reply qilib /msg [extra]
 # =========================
 
+MSG_USAGE = (
+    "Ishlatish (postga reply): /msg [--verified] [--since=YYYY-MM-DD] [--top=N] [--all] [qo‘shimcha matn]\n"
+    "--verified — faqat obunasi tasdiqlanganlar\n"
+    "--since — shu kundan keyin qo‘shilganlar\n"
+    "--top — TOP-N referrer\n"
+    "--all — botni bloklaganlarga ham urinib ko‘rish"
+)
+
+
+def _parse_segment(args: str) -> Tuple[Dict[str, Any], str]:
+    """
+    /msg boshidagi --flag'lar -> segment, qolgani — qo'shimcha matn.
+    """
+    segment: Dict[str, Any] = {}
+    rest = args.strip()
+    while rest.startswith("--"):
+        parts = rest.split(maxsplit=1)
+        flag = parts[0]
+        rest = parts[1].strip() if len(parts) == 2 else ""
+
+        name, _, value = flag[2:].partition("=")
+        if name == "verified" and not value:
+            segment["verified"] = True
+        elif name == "all" and not value:
+            segment["include_blocked"] = True
+        elif name == "since":
+            try:
+                d = datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise ValueError(f"Sana noto‘g‘ri: {flag}")
+            segment["since"] = d.replace(tzinfo=timezone.utc)
+        elif name == "top":
+            if not value.isdigit() or int(value) <= 0:
+                raise ValueError(f"TOP soni noto‘g‘ri: {flag}")
+            segment["top"] = int(value)
+        else:
+            raise ValueError(f"Noma’lum flag: {flag}")
+
+    return segment, rest
+
+
+def _fmt_segment(segment: Dict[str, Any]) -> str:
+    parts = []
+    if segment.get("verified"):
+        parts.append("verified")
+    if segment.get("since") is not None:
+        parts.append(f"{segment['since']:%Y-%m-%d} dan")
+    if segment.get("top"):
+        parts.append(f"TOP-{int(segment['top'])}")
+    if segment.get("include_blocked"):
+        parts.append("bloklaganlar ham")
+    return ", ".join(parts) if parts else "hamma"
+
+
 @router_admin.message(Command("msg"))
 async def cmd_msg(message: Message):
     if not await _reply_admin_only(message):
         return
 
-    bot = message.bot
-
     if not message.reply_to_message:
         await message.answer("Hammaga yuborish uchun biror xabarga reply qiling, so‘ng /msg yozing.")
         return
 
     extra = (message.text or "").split(maxsplit=1)
-    extra_text = extra[1].strip() if len(extra) == 2 else ""
-
-    users = await get_all_user_ids()
-    sent = 0
-    failed = 0
+    try:
+        segment, extra_text = _parse_segment(extra[1] if len(extra) == 2 else "")
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{MSG_USAGE}")
+        return
 
     src = message.reply_to_message
+    payload = await compile_payload(src, extra_text)
+
+    # yuborish fonda (leader'da) — broadcast.py; progress broadcast_jobs'da
+    job_id = await broadcast_create(
+        created_by=message.from_user.id,
+        src_chat_id=src.chat.id,
+        src_message_id=src.message_id,
+        src_text=src.text,
+        src_caption=src.caption,
+        extra_text=extra_text,
+        segment=segment,
+        payload=payload,
+    )
+
+    await message.answer(
+        f"📣 Broadcast #{job_id} navbatga qo‘yildi ({_fmt_segment(segment)}).\n"
+        f"Holat: /bc_status {job_id}\n"
+        f"Bekor qilish: /bc_cancel {job_id}"
+    )
 
-    # Flood'dan saqlash (10k userda shart)
-    BATCH = 25
-    SLEEP = 0.2  # seconds
 
-    for i, uid in enumerate(users, start=1):
-        try:
-            # TEXT bo'lsa
-            if src.text:
-                base = src.text
-                final_text = (extra_text + "\n\n" + base).strip() if extra_text else base
-                final_text = await merge_text_with_ad(final_text)
-                await bot.send_message(uid, final_text)
+def _job_id_arg(message: Message) -> Optional[int]:
+    parts = _split_args(message.text)
+    if len(parts) == 2 and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+
+def _fmt_job(job) -> str:
+    done = int(job["sent"]) + int(job["failed"]) + int(job["blocked"])
+    total = int(job["total"])
+    pct = f" ({done * 100 // total}%)" if total else ""
 
-            # MEDIA bo'lsa
-            else:
-                cap = src.caption or ""
-                combined = (extra_text + "\n\n" + cap).strip() if extra_text else cap
-                final_caption = (await merge_text_with_ad(combined)).strip()
+    lines = [
+        f"📣 Broadcast #{int(job['id'])} — {job['status']} ({_fmt_segment(job_segment(job))})",
+        f"Yuborildi: {int(job['sent'])}, xato: {int(job['failed'])}, "
+        f"bloklagan: {int(job['blocked'])} / {total}{pct}",
+    ]
 
-                await bot.copy_message(
-                    chat_id=uid,
-                    from_chat_id=src.chat.id,
-                    message_id=src.message_id,
-                    caption=final_caption if final_caption else None,
-                )
+    elapsed = float(job["elapsed"] or 0)
+    if elapsed > 0 and done > 0:
+        rate = done / elapsed
+        line = f"Tezlik: {rate:.1f} msg/s, vaqt: {int(elapsed)} s"
+        if job["status"] in ("pending", "running") and total > done:
+            line += f", qolgan: ~{int((total - done) / rate)} s"
+        lines.append(line)
+
+    if job["last_error"]:
+        lines.append(f"Oxirgi xato ({int(job['errors'])}): {html.escape(job['last_error'])}")
+
+    return "\n".join(lines)
 
-            sent += 1
-        except Exception:
-            failed += 1
 
-        if i % BATCH == 0:
-            await asyncio.sleep(SLEEP)
+@router_admin.message(Command("bc_status"))
+async def cmd_bc_status(message: Message):
+    if not await _reply_admin_only(message):
+        return
+
+    job = await broadcast_get(_job_id_arg(message))
+    if not job:
+        await message.answer("Broadcast yo‘q.")
+        return
+
+    await message.answer(_fmt_job(job))
+
+
+@router_admin.message(Command("bc_cancel"))
+async def cmd_bc_cancel(message: Message):
+    if not await _reply_admin_only(message):
+        return
+
+    job_id = await broadcast_cancel(_job_id_arg(message))
+    if job_id is None:
+        await message.answer("Bekor qilinadigan broadcast yo‘q.")
+        return
 
-    await message.answer(f"Yuborildi: {sent} ta, xato: {failed} ta")
+    await message.answer(f"Broadcast #{job_id} bekor qilindi.")
 
 
 # =========================
@@ -383,7 +491,11 @@ async def cmd_channel_add(message: Message):
         await message.answer("Ishlatish: /channel_add @kanal")
         return
 
-    await channel_add(parts[1])
+    username = parts[1].strip()
+    # numeric id'ni darhol olamiz (bot kanalda admin bo'lmasa — keyin lazy)
+    chat_id = await resolve_chat_id(message.bot, username)
+    await channel_add(username, chat_id)
+    await channels_reload()
     await message.answer("Kanal qo‘shildi.")
 
 
@@ -398,6 +510,7 @@ async def cmd_channel_del(message: Message):
         return
 
     await channel_del(parts[1])
+    await channels_reload()
     await message.answer("Kanal o‘chirildi.")
 
 
@@ -409,7 +522,10 @@ ADMIN_HELP_TEXT = (
     "🛠 <b>ADMIN YORDAM MENYUSI</b>\n\n"
     "📊 <b>Statistika</b>\n"
     "• <b>/stats</b> — umumiy statistika\n"
-    "• <b>/top</b> — TOP-20 referrers\n\n"
+    "• <b>/stats exact</b> — jadvallardan aniq sanash (sekinroq)\n"
+    "• <b>/stats_rebuild</b> — statistika hisoblagichlarini qayta hisoblash\n"
+    "• <b>/top</b> — TOP-20 referrers\n"
+    "• <b>/scores_rebuild</b> — reyting jadvalini qayta hisoblash\n\n"
     "🎛 <b>Konkurs boshqaruvi</b>\n"
     "• <b>/start_contest</b> — konkursni yoqish\n"
     "• <b>/stop</b> — konkursni to‘xtatish (userlar uchun yopiladi)\n"
@@ -428,7 +544,10 @@ ADMIN_HELP_TEXT = (
     "• <b>/prize_add</b> <code>1|Title|Desc</code> — sovg‘a qo‘shish\n"
     "• <b>/prize_del</b> <code>&lt;id&gt;</code> — sovg‘a o‘chirish\n\n"
     "📣 <b>E’lon (broadcast)</b>\n"
-    "• (postga reply qiling) <b>/msg</b> <i>[qo‘shimcha matn]</i> — hammaga yuborish\n\n"
+    "• (postga reply qiling) <b>/msg</b> <i>[qo‘shimcha matn]</i> — hammaga yuborish (fonda)\n"
+    "• <b>/msg</b> <code>--verified --since=2026-01-01 --top=100 --all</code> — segment bo‘yicha\n"
+    "• <b>/bc_status</b> <i>[id]</i> — broadcast holati va tezligi\n"
+    "• <b>/bc_cancel</b> <i>[id]</i> — broadcast'ni bekor qilish\n\n"
     "📢 <b>Kanallar</b>\n"
     "• <b>/channels</b> — kanallar ro‘yxati\n"
     "• <b>/channel_add</b> <code>@kanal</code> — kanal qo‘shish\n"
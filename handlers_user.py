@@ -1,26 +1,35 @@
 from __future__ import annotations
 
+import logging
 from typing import Optional
 
 from aiogram import Router, F, Bot
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated
 
+from config import SUB_SINGLEFLIGHT_REUSE
 from db import (
-    upsert_user, ensure_referral, set_verified,
-    credit_referrer_if_needed, get_user,
-    get_stats_for_user, get_rank, get_top, prize_list,
-    is_verified,
+    register_user,
+    verify_and_credit, get_user,
+    get_stats_for_user, prize_list,
 )
+from leaderboard import get_rank, get_top, leaderboard_credit
 from keyboards import kb_home, kb_subscribe
-from subscriptions import check_subscriptions
+from singleflight import SingleFlight
+from subscriptions import check_subscriptions, record_chat_member
 from utils import (
     build_motivation_text, guard_contest, merge_text_with_ad,
     parse_ref_code, ref_link,
 )
 
+log = logging.getLogger(__name__)
+
 router_user = Router()
 
+# confirm_sub: bir user'ning parallel bosishlari bitta verified+credit yo'lini bo'lishadi
+verify_flight = SingleFlight(reuse_window=SUB_SINGLEFLIGHT_REUSE)
+verify_counters = {"db_writes": 0}
+
 
 async def prize_text(is_admin_view: bool = False) -> str:
     rows = await prize_list()
@@ -52,16 +61,14 @@ async def start_handler(message: Message):
 
     user_id = message.from_user.id
 
-    await upsert_user(
+    # user + pending referral bitta query'da (self-referral SQL'da tashlanadi)
+    await register_user(
         user_id=user_id,
         username=message.from_user.username or "",
         first_name=message.from_user.first_name or "",
         referrer_id=referrer_id,
     )
 
-    if referrer_id and referrer_id != user_id:
-        await ensure_referral(invited_user_id=user_id, referrer_id=referrer_id)
-
     text = (
         f"🌟 <b>KONKURS BOSHLANDI, {message.from_user.first_name}!</b> 🌟\n\n"
         "🏆 <b>Ajoyib sovrinlar sizni kutmoqda!</b>\n\n"
@@ -149,6 +156,37 @@ def build_sub_check_message(missing_channels: list[str]) -> str:
     return "\n".join(lines)
 
 
+async def _verify_and_credit(bot: Bot, user_id: int) -> None:
+    # ✅ anti-cheat: faqat 1 marta verified + credit (bitta atomik query)
+    verified_now, referrer_id, score = await verify_and_credit(user_id)
+    verify_counters["db_writes"] += 1
+    if not verified_now:
+        return
+
+    if referrer_id:
+        # credit commit bo'lgan — xotiradagi reyting xatosi confirm_sub'ni buzmasin
+        # (fon tekshiruvi DB bilan farqni topib qayta yuklaydi)
+        try:
+            await leaderboard_credit(referrer_id, score)
+        except Exception:
+            log.exception("leaderboard credit xato (referrer %s)", referrer_id)
+        try:
+            mot = await build_motivation_text(referrer_id)
+            await bot.send_message(
+                referrer_id,
+                await merge_text_with_ad(
+                    "🎉 Sizning havolangiz orqali 1 ta haqiqiy ishtirokchi qo‘shildi! (+1)\n\n" + mot
+                ),
+                parse_mode="HTML",
+            )
+        except Exception:
+            pass
+
+
+def verify_stats() -> dict:
+    return {"singleflight": verify_flight.stats(), **verify_counters}
+
+
 @router_user.callback_query(F.data == "confirm_sub")
 async def confirm_sub(cb: CallbackQuery, bot: Bot):
     if not await guard_contest(cb):
@@ -157,7 +195,7 @@ async def confirm_sub(cb: CallbackQuery, bot: Bot):
     await cb.answer()
     user_id = cb.from_user.id
 
-    ok, missing = await check_subscriptions(bot, user_id)
+    ok, missing = await check_subscriptions(bot, user_id, for_credit=True)
     if not ok:
         await cb.message.answer(
             await merge_text_with_ad(build_sub_check_message(missing)),
@@ -166,24 +204,7 @@ async def confirm_sub(cb: CallbackQuery, bot: Bot):
         )
         return
 
-    # ✅ anti-cheat: faqat 1 marta verified + credit
-    already = bool(await is_verified(user_id))
-    if not already:
-        await set_verified(user_id, True)
-        referrer_id = await credit_referrer_if_needed(invited_user_id=user_id)
-
-        if referrer_id:
-            try:
-                mot = await build_motivation_text(referrer_id)
-                await bot.send_message(
-                    referrer_id,
-                    await merge_text_with_ad(
-                        "🎉 Sizning havolangiz orqali 1 ta haqiqiy ishtirokchi qo‘shildi! (+1)\n\n" + mot
-                    ),
-                    parse_mode="HTML",
-                )
-            except Exception:
-                pass
+    await verify_flight.do(user_id, lambda: _verify_and_credit(bot, user_id))
 
     link = ref_link(user_id)
 
@@ -269,3 +290,18 @@ async def show_prizes(cb: CallbackQuery):
         reply_markup=await kb_home(),
         parse_mode="HTML",
     )
+
+
+# =========================
+# chat_member push (bot kanalda admin bo'lsa Telegram o'zi yuboradi)
+# =========================
+@router_user.chat_member()
+async def on_chat_member(event: ChatMemberUpdated):
+    # konkurs yopiq bo'lsa ham a'zolik holati yangilanib turadi
+    await record_chat_member(
+        chat_id=event.chat.id,
+        chat_username=event.chat.username,
+        user_id=event.new_chat_member.user.id,
+        status=event.new_chat_member.status,
+        at=event.date,
+    )
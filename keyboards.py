@@ -1,52 +1,131 @@
-from typing import Optional, List
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from pydantic import ConfigDict
 
 from db import get_setting
 
 
+# =========================
+# Tayyor (cache'langan) klaviaturalar
+# =========================
+class _FrozenMarkup(InlineKeyboardMarkup):
+    # bitta obyekt ko'p javoblarda umumiy ishlatiladi — o'zgartirib bo'lmaydi
+    model_config = ConfigDict(frozen=True)
+
+
+class _Cached(NamedTuple):
+    key: Tuple[str, str]               # (ad_btn_text, ad_btn_url)
+    markup: Optional[InlineKeyboardMarkup]
+    json: Optional[str]                # faqat reklama tugmasi (broadcast job'ida saqlanadi)
+
+
+def _cached(
+    key: Tuple[str, str], rows: Optional[List[List[InlineKeyboardButton]]], dump_json: bool = False
+) -> _Cached:
+    if rows is None:
+        return _Cached(key, None, None)
+    markup = _FrozenMarkup(inline_keyboard=rows)
+    # javoblarda markup obyekti beriladi (aiogram o'zi serialize qiladi) —
+    # JSON faqat kerak joyda hisoblanadi
+    return _Cached(key, markup, markup.model_dump_json(exclude_none=True) if dump_json else None)
+
+
+_HOME_ROWS = [
+    [InlineKeyboardButton(text="🚀 Ishtirok etish", callback_data="join_flow")],
+    [InlineKeyboardButton(text="📊 Mening natijam", callback_data="my_stats")],
+    [InlineKeyboardButton(text="🏆 Top-10", callback_data="show_top")],
+    [InlineKeyboardButton(text="🎁 Sovg‘alar", callback_data="show_prizes")],
+]
+
+# settings snapshot'dagi reklama tugmasi o'zgarsa (NOTIFY orqali) — kalit
+# o'zgaradi va klaviatura keyingi chaqiruvda bir marta qayta yig'iladi
+_home: Optional[_Cached] = None
+_ad: Optional[_Cached] = None
+
+
+async def _ad_key() -> Tuple[str, str]:
+    return (
+        (await get_setting("ad_btn_text", "")).strip(),
+        (await get_setting("ad_btn_url", "")).strip(),
+    )
+
+
 async def kb_home() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton(text="🚀 Ishtirok etish", callback_data="join_flow")],
-        [InlineKeyboardButton(text="📊 Mening natijam", callback_data="my_stats")],
-        [InlineKeyboardButton(text="🏆 Top-10", callback_data="show_top")],
-        [InlineKeyboardButton(text="🎁 Sovg‘alar", callback_data="show_prizes")],
-    ]
+    global _home
+    key = await _ad_key()
+    if _home is None or _home.key != key:
+        ad_txt, ad_url = key
+        keyboard = list(_HOME_ROWS)
+        if ad_txt and ad_url:
+            keyboard.append([InlineKeyboardButton(text=f"📢 {ad_txt}", url=ad_url)])
+        _home = _cached(key, keyboard)
+    return _home.markup
+
 
-    ad_txt = (await get_setting("ad_btn_text", "")).strip()
-    ad_url = (await get_setting("ad_btn_url", "")).strip()
-    if ad_txt and ad_url:
-        keyboard.append([InlineKeyboardButton(text=f"📢 {ad_txt}", url=ad_url)])
+# subscriptions.channels_reload tayyorlab qo'yadi: username -> tugma
+_channel_buttons: Dict[str, InlineKeyboardButton] = {}
 
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+# yetishmayotgan kanallar to'plami -> tayyor klaviatura (kanallar o'zgarsa tozalanadi)
+_subscribe_cache: Dict[Tuple[str, ...], InlineKeyboardMarkup] = {}
+_SUBSCRIBE_CACHE_MAX = 512
+
+
+def channel_button(i: int, ch: str) -> InlineKeyboardButton:
+    if ch.startswith("@"):
+        url = f"https://t.me/{ch.lstrip('@')}"
+        label = f"📢 {ch}"
+    else:
+        url = ch
+        label = f"📢 Kanal {i}"
+    return InlineKeyboardButton(text=label, url=url)
+
+
+def set_channel_buttons(buttons: Dict[str, InlineKeyboardButton]) -> None:
+    global _channel_buttons
+    _channel_buttons = buttons
+    _subscribe_cache.clear()
 
 
 async def kb_subscribe(channels: List[str]) -> InlineKeyboardMarkup:
+    key = tuple(channels)
+    cached = _subscribe_cache.get(key)
+    if cached is not None:
+        return cached
+
     rows = []
     for i, ch in enumerate(channels, start=1):
         ch = (ch or "").strip()
         if not ch:
             continue
 
-        if ch.startswith("@"):
-            url = f"https://t.me/{ch.lstrip('@')}"
-            label = f"📢 {ch}"
-        else:
-            url = ch
-            label = f"📢 Kanal {i}"
-
-        rows.append([InlineKeyboardButton(text=label, url=url)])
+        btn = _channel_buttons.get(ch)
+        if btn is None:
+            btn = channel_button(i, ch)
+        rows.append([btn])
 
     rows.append([InlineKeyboardButton(text="✅ Obunani tasdiqlash", callback_data="confirm_sub")])
     rows.append([InlineKeyboardButton(text="⬅️ Orqaga", callback_data="back_home")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+    if len(_subscribe_cache) >= _SUBSCRIBE_CACHE_MAX:
+        _subscribe_cache.clear()
+    markup = _subscribe_cache[key] = _FrozenMarkup(inline_keyboard=rows)
+    return markup
+
+
+async def _ad_cached() -> _Cached:
+    global _ad
+    key = await _ad_key()
+    if _ad is None or _ad.key != key:
+        txt, url = key
+        _ad = _cached(key, [[InlineKeyboardButton(text=txt, url=url)]] if txt and url else None, dump_json=True)
+    return _ad
 
 
 async def kb_ad_button_if_set() -> Optional[InlineKeyboardMarkup]:
-    txt = (await get_setting("ad_btn_text", "")).strip()
-    url = (await get_setting("ad_btn_url", "")).strip()
-    if txt and url:
-        return InlineKeyboardMarkup(
-            inline_keyboard=[[InlineKeyboardButton(text=txt, url=url)]]
-        )
-    return None
+    return (await _ad_cached()).markup
+
+
+async def kb_ad_button_json() -> Optional[str]:
+    # broadcast job'ida saqlash uchun tayyor JSON
+    return (await _ad_cached()).json
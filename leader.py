@@ -0,0 +1,151 @@
+"""
+Ko'p worker / ko'p replika rejimi uchun leader tanlash.
+
+Har bir process alohida (pool'dan tashqari) connection'da
+pg_try_advisory_lock oladi. Lock kimda bo'lsa — o'sha leader:
+migratsiyalar, webhook o'rnatish va bir nusxada ishlashi kerak bo'lgan
+fon ishlar faqat unda. Leader o'lsa connection yopiladi, lock bo'shaydi
+va qolganlardan biri retry loop'da uni oladi.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import asyncpg
+
+from config import DATABASE_URL
+
+log = logging.getLogger(__name__)
+
+JobFn = Callable[[], Awaitable[Any]]
+
+
+class LeaderElection:
+    def __init__(self, key: int, *, retry_interval: float = 5.0) -> None:
+        self._key = int(key)
+        self._retry_interval = float(retry_interval)
+        self._conn: Optional[asyncpg.Connection] = None
+        self._callbacks: List[JobFn] = []
+        self._jobs: List[JobFn] = []
+        self._job_tasks: List[asyncio.Task] = []
+        self._retry_task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.is_leader = False
+        self.elections = 0
+
+    def on_elected(self, fn: JobFn) -> JobFn:
+        """
+        Leader bo'lganda bir marta chaqiriladi (failover'da ham).
+        """
+        self._callbacks.append(fn)
+        return fn
+
+    def background(self, fn: JobFn) -> JobFn:
+        """
+        Faqat leader'da ishlaydigan uzoq fon ish (leadership yo'qolsa to'xtaydi).
+        """
+        self._jobs.append(fn)
+        return fn
+
+    async def try_acquire(self) -> bool:
+        if self.is_leader:
+            return True
+
+        if self._conn is None or self._conn.is_closed():
+            self._conn = await asyncpg.connect(dsn=DATABASE_URL)
+            self._conn.add_termination_listener(self._on_conn_lost)
+
+        self.is_leader = bool(
+            await self._conn.fetchval("SELECT pg_try_advisory_lock($1)", self._key)
+        )
+        return self.is_leader
+
+    async def start(self) -> None:
+        """
+        try_acquire'dan keyin (DB tayyor bo'lgach) chaqiriladi.
+        Birinchi saylovda on_elected xatosi shu yerdan chiqadi — startup yiqiladi
+        (masalan, webhook o'rnatilmagan process /health'dan o'tmasin).
+        """
+        if self.is_leader:
+            await self._become_leader(raise_errors=True)
+        else:
+            self._start_retry()
+
+    async def _run_callback(self, cb: JobFn) -> None:
+        # failover'da: xato bo'lsa backoff bilan qayta, leadership yo'qolguncha
+        delay = 1.0
+        while True:
+            try:
+                await cb()
+                return
+            except Exception:
+                log.exception("on_elected callback xato: %s (%.0fs dan keyin qayta)",
+                              getattr(cb, "__name__", cb), delay)
+            await asyncio.sleep(delay)
+            if self._stopping or not self.is_leader:
+                return
+            delay = min(delay * 2, 60.0)
+
+    async def _become_leader(self, *, raise_errors: bool = False) -> None:
+        self.elections += 1
+        log.info("leader bo'ldik (lock=%s)", self._key)
+
+        for cb in self._callbacks:
+            if raise_errors:
+                await cb()
+            else:
+                await self._run_callback(cb)
+
+        if self._stopping or not self.is_leader:
+            return
+
+        for job in self._jobs:
+            self._job_tasks.append(asyncio.create_task(job(), name=f"leader-{job.__name__}"))
+
+    def _start_retry(self) -> None:
+        if self._stopping or (self._retry_task is not None and not self._retry_task.done()):
+            return
+        self._retry_task = asyncio.create_task(self._retry_loop(), name="leader-retry")
+
+    async def _retry_loop(self) -> None:
+        while not self._stopping:
+            await asyncio.sleep(self._retry_interval)
+            try:
+                if await self.try_acquire():
+                    await self._become_leader()
+                    return
+            except Exception:
+                log.exception("leader lock olishda xato")
+
+    def _stop_jobs(self) -> None:
+        for t in self._job_tasks:
+            t.cancel()
+        self._job_tasks.clear()
+
+    def _on_conn_lost(self, conn: asyncpg.Connection) -> None:
+        if self._stopping:
+            return
+        if self.is_leader:
+            log.warning("leader connection uzildi — leadership yo'qotildi")
+        self.is_leader = False
+        self._stop_jobs()
+        self._start_retry()
+
+    async def stop(self) -> None:
+        self._stopping = True
+        if self._retry_task is not None:
+            self._retry_task.cancel()
+        self._stop_jobs()
+
+        if self._conn is not None and not self._conn.is_closed():
+            # connection yopilishi lock'ni ham bo'shatadi
+            await self._conn.close()
+        self._conn = None
+        self.is_leader = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "is_leader": self.is_leader,
+            "elections": self.elections,
+            "jobs": len(self._job_tasks),
+        }
@@ -0,0 +1,219 @@
+"""
+In-memory reyting: get_rank / get_top1_score pool'ga tegmaydi, get_top —
+faqat ismlar uchun bitta kichik query.
+
+Bir marta referrer_scores'dan yuklanadi va verify_and_credit referrer
+hamda uning yangi balini qaytarganda shu process ichida yangilanadi. Boshqa worker/replika
+qilgan credit'lar davriy tekshiruvda (count/sum/max va users'dagi ball
+egalari soni DB bilan solishtiriladi) topiladi va farq bo'lsa reyting qayta
+yuklanadi. Ism/username xotirada saqlanmaydi — TOP uchun oxirgi N ta
+user'niki bitta query bilan o'qiladi (o'zgargan ism darhol ko'rinadi).
+
+Tuzilma:
+  _scores   user_id -> ball (faqat > 0, users'da yo'qlari ham)
+  _distinct users'dagi ball egalarining turli ballari, o'sish tartibida
+            (rank = bisect, O(log n))
+  _buckets  ball -> [(created_ts, user_id)] tartiblangan (TOP uchun, faqat users)
+"""
+import asyncio
+import bisect
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import LEADERBOARD_SYNC_INTERVAL
+import db
+
+log = logging.getLogger(__name__)
+
+
+class _Board:
+    def __init__(self) -> None:
+        self.loaded = False
+        self._scores: Dict[int, int] = {}
+        self._meta: Dict[int, Tuple[float, bool]] = {}  # created_ts, in_users
+        self._distinct: List[int] = []
+        self._buckets: Dict[int, List[Tuple[float, int]]] = {}
+        self.reloads = 0
+        self.mismatches = 0
+
+    # ---- ichki ----
+    def _add(self, uid: int, score: int) -> None:
+        self._scores[uid] = score
+        # users'da yo'q ball egasi reyting/TOP'ga kirmaydi (DENSE_RANK ham users bo'yicha)
+        if not self._meta[uid][1]:
+            return
+        key = (self._meta[uid][0], uid)
+        bucket = self._buckets.get(score)
+        if bucket is None:
+            bucket = self._buckets[score] = []
+            bisect.insort(self._distinct, score)
+        bisect.insort(bucket, key)
+
+    def _remove(self, uid: int) -> None:
+        score = self._scores.pop(uid, None)
+        if score is None or not self._meta[uid][1]:
+            return
+        bucket = self._buckets[score]
+        key = (self._meta[uid][0], uid)
+        i = bisect.bisect_left(bucket, key)
+        if i < len(bucket) and bucket[i] == key:
+            bucket.pop(i)
+        if not bucket:
+            del self._buckets[score]
+            self._distinct.pop(bisect.bisect_left(self._distinct, score))
+
+    # ---- yuklash / yangilash ----
+    def replace(self, rows: List[Any]) -> None:
+        self._scores.clear()
+        self._meta.clear()
+        self._distinct.clear()
+        self._buckets.clear()
+        for r in rows:
+            uid = int(r["user_id"])
+            self._meta[uid] = (r["created_at"].timestamp(), bool(r["in_users"]))
+            self._add(uid, int(r["score"]))
+        self.loaded = True
+        self.reloads += 1
+
+    def set_meta(self, uid: int, created_ts: float, in_users: bool) -> None:
+        score = self._scores.get(uid)
+        if score is not None:
+            self._remove(uid)
+        self._meta[uid] = (created_ts, in_users)
+        if score is not None:
+            self._add(uid, score)
+
+    def has_meta(self, uid: int) -> bool:
+        return uid in self._meta
+
+    def set_score(self, uid: int, score: int) -> None:
+        self._remove(uid)
+        if score > 0:
+            self._add(uid, score)
+
+    # ---- o'qish ----
+    def score(self, uid: int) -> int:
+        return self._scores.get(uid, 0)
+
+    def rank(self, uid: int) -> Optional[int]:
+        # DENSE_RANK: 1 + o'zidan katta turli ballar soni.
+        # Ball egasi bo'lmagan id users'da deb olinadi (chaqiruvchilar tekshiradi).
+        meta = self._meta.get(uid)
+        if meta is not None and not meta[1]:
+            return None
+        s = self._scores.get(uid, 0)
+        return 1 + len(self._distinct) - bisect.bisect_right(self._distinct, s)
+
+    def top1(self) -> int:
+        return self._distinct[-1] if self._distinct else 0
+
+    def top(self, limit: int) -> List[Tuple[int, int]]:
+        # [(user_id, ball)] — ismlar get_top'da DB'dan
+        out: List[Tuple[int, int]] = []
+        for score in reversed(self._distinct):
+            for _, uid in self._buckets[score]:
+                out.append((uid, score))
+                if len(out) >= limit:
+                    return out
+        return out
+
+    def fingerprint(self) -> Tuple[int, int, int, int]:
+        # db.referrer_scores_summary bilan bir xil: (soni, yig'indi, max, users'dagilar soni)
+        return (
+            len(self._scores),
+            sum(self._scores.values()),
+            max(self._scores.values(), default=0),
+            sum(1 for uid in self._scores if self._meta[uid][1]),
+        )
+
+
+_board = _Board()
+
+
+async def leaderboard_load() -> None:
+    _board.replace(await db.referrer_scores_all())
+
+
+async def _ensure_meta(uid: int) -> None:
+    if _board.has_meta(uid):
+        return
+    row = await db.referrer_meta(uid)
+    _board.set_meta(uid, row["created_at"].timestamp(), bool(row["in_users"]))
+
+
+async def leaderboard_credit(referrer_id: int, score: Optional[int] = None) -> None:
+    """
+    Credit'dan keyin. score — DB qaytargan yangi ball (verify_and_credit);
+    None bo'lsa +1. Yangi referrer uchun faqat birinchi marta ism/created_at o'qiladi.
+    """
+    if not _board.loaded:
+        return
+    uid = int(referrer_id)
+    await _ensure_meta(uid)
+    _board.set_score(uid, int(score) if score is not None else _board.score(uid) + 1)
+
+
+async def leaderboard_check() -> bool:
+    """
+    DB bilan solishtirish (count/sum/max/users'dagilar). Farq bo'lsa — qayta yuklash.
+    Qaytaradi: mos kelganmi.
+    """
+    if await db.referrer_scores_summary() == _board.fingerprint():
+        return True
+
+    _board.mismatches += 1
+    await leaderboard_load()
+    return False
+
+
+async def leaderboard_sync_loop() -> None:
+    while True:
+        await asyncio.sleep(LEADERBOARD_SYNC_INTERVAL)
+        try:
+            await leaderboard_check()
+        except Exception:
+            log.exception("leaderboard tekshiruvi xato")
+
+
+def leaderboard_stats() -> Dict[str, Any]:
+    n, total, _, in_users = _board.fingerprint()
+    return {
+        "loaded": _board.loaded,
+        "scorers": n,
+        "user_scorers": in_users,
+        "total": total,
+        "top1": _board.top1(),
+        "reloads": _board.reloads,
+        "mismatches": _board.mismatches,
+    }
+
+
+# =========================
+# db.get_top / get_rank / get_top1_score o'rniga
+# (reyting yuklanmagan bo'lsa — DB'ga qaytadi)
+# =========================
+async def get_top(limit: int = 10) -> List[Any]:
+    if not _board.loaded:
+        return await db.get_top(limit)
+    top = _board.top(limit)
+    if len(top) < limit:
+        # ball egalari kam — 0 balli user'lar bilan to'ldirish DB'da
+        return await db.get_top(limit)
+    names = await db.user_names([uid for uid, _ in top])
+    rows = []
+    for uid, score in top:
+        first_name, username = names.get(uid, ("", ""))
+        rows.append({"user_id": uid, "first_name": first_name, "username": username, "score": score})
+    return rows
+
+
+async def get_rank(user_id: int) -> Optional[int]:
+    if not _board.loaded:
+        return await db.get_rank(user_id)
+    return _board.rank(int(user_id))
+
+
+async def get_top1_score() -> int:
+    if not _board.loaded:
+        return await db.get_top1_score()
+    return _board.top1()
@@ -1,16 +1,49 @@
+import asyncio
+import hashlib
 import os
 
+try:
+    import orjson  # ixtiyoriy: webhook body va Bot API javoblarini tezroq parse qiladi
+except ImportError:
+    orjson = None
+
 from fastapi import FastAPI, Request, Response, HTTPException
+from pydantic import ValidationError
 import uvicorn
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.types import Update
 
-from config import BOT_TOKEN
-from db import db_init, db_close
-from handlers_user import router_user
+from config import (
+    BOT_TOKEN,
+    UPDATE_MODE, UPDATE_QUEUE_SIZE, UPDATE_WORKERS,
+    UPDATE_DRAIN_ON_SHUTDOWN, UPDATE_DRAIN_TIMEOUT,
+    UPDATE_DEDUP_WINDOW,
+    SHED_MAX_INFLIGHT, SHED_POOL_WAIT_MS, SHED_RETRY_AFTER,
+    WEBHOOK_DROP_PENDING,
+    WEB_CONCURRENCY,
+    RATE_GLOBAL_SENDS, RATE_BROADCAST_SENDS, RATE_GET_CHAT_MEMBER, RATE_PER_CHAT,
+    RATE_PER_CHAT_BURST, RATE_GROUP_PER_MIN, RATE_RETRY_MAX,
+)
+from db import (
+    db_init, db_close,
+    get_setting, set_setting, settings_reload, SETTINGS_CHANNEL,
+    admins_reload, ADMINS_CHANNEL, CHANNELS_CHANNEL, BROADCAST_CHANNEL,
+)
+from admission import Admission
+from broadcast import broadcast_loop, broadcast_stats, broadcast_wakeup
+from dedup import UpdateDedup, peek_update_id
+from dispatch import UpdateQueue, update_user_id
+from leader import LeaderElection
+from leaderboard import leaderboard_load, leaderboard_stats, leaderboard_sync_loop
+from ratelimit import BotRateLimiter
+from notify import notify_start, notify_stop, notify_stats, on_notify
+from subscriptions import channels_reload, subscriptions_stats
+from handlers_user import router_user, verify_stats
 from handlers_admin import router_admin
+from utils import is_admin
 
 
 # =========================
@@ -34,6 +67,8 @@ if not WEBHOOK_SECRET:
 
 WEBHOOK_PATH = f"/webhook/{WEBHOOK_SECRET}"
 WEBHOOK_URL = f"{BASE_URL}{WEBHOOK_PATH}"
+WEBHOOK_FINGERPRINT_KEY = "webhook_fingerprint"
+LEADER_LOCK_KEY = 72810002
 
 
 # =========================
@@ -41,27 +76,140 @@ WEBHOOK_URL = f"{BASE_URL}{WEBHOOK_PATH}"
 # =========================
 app = FastAPI()
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+def _make_session() -> AiohttpSession:
+    if orjson is None:
+        return AiohttpSession()
+    return AiohttpSession(
+        json_loads=orjson.loads,
+        json_dumps=lambda v: orjson.dumps(v).decode(),
+    )
+
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=_make_session(),
+    default=DefaultBotProperties(parse_mode="HTML"),
+)
+# barcha bot.* chaqiruvlari uchun umumiy tezlik nazorati
+rate_limiter = BotRateLimiter(
+    global_rate=RATE_GLOBAL_SENDS,
+    chat_rate=RATE_PER_CHAT,
+    chat_burst=RATE_PER_CHAT_BURST,
+    group_per_min=RATE_GROUP_PER_MIN,
+    member_rate=RATE_GET_CHAT_MEMBER,
+    broadcast_rate=RATE_BROADCAST_SENDS,
+    max_retries=RATE_RETRY_MAX,
+)
+bot.session.middleware(rate_limiter)
+
 dp = Dispatcher()
 dp.include_router(router_admin)
 dp.include_router(router_user)
 
 
+# bir vaqtda ishlayotgan feed_update + pool kutish vaqti bo'yicha load shedding
+admission = Admission(max_inflight=SHED_MAX_INFLIGHT, max_pool_wait_ms=SHED_POOL_WAIT_MS)
+
+
+async def _feed(update: Update) -> None:
+    admission.enter()
+    try:
+        await dp.feed_update(bot, update)
+    finally:
+        admission.leave()
+
+
+async def _feed_inline(update: Update) -> None:
+    # xato bo'lsa Telegram qayta yuboradi — dedup uni tashlab yubormasin
+    try:
+        await _feed(update)
+    except Exception:
+        update_dedup.forget(update.update_id)
+        raise
+
+
+async def _is_admin_update(update: Update) -> bool:
+    # router_admin buyruqlari yuklama paytida ham ishlashi kerak.
+    # is_admin xotiradagi admin keshidan o'qiydi — band pool'ga tegmaydi.
+    uid = update_user_id(update)
+    return uid is not None and await is_admin(uid)
+
+
+# advisory lock bilan bitta leader: migratsiya, webhook, fon ishlar
+leader = LeaderElection(LEADER_LOCK_KEY)
+
+# har bir worker'da ishlaydigan fon task'lar (shutdown'da to'xtatiladi)
+_background: list[asyncio.Task] = []
+
+# qayta yuborilgan (retry) update'larni tashlash uchun
+update_dedup = UpdateDedup(UPDATE_DEDUP_WINDOW)
+
+# UPDATE_MODE=queue bo'lsa webhook update'ni navbatga qo'yib darhol javob beradi
+update_queue = (
+    UpdateQueue(_feed, workers=UPDATE_WORKERS, maxsize=UPDATE_QUEUE_SIZE)
+    if UPDATE_MODE == "queue" else None
+)
+
+
 # =========================
 # Lifecycle
 # =========================
 @app.on_event("startup")
 async def on_startup():
+    # har process o'zi migratsiya qiladi: run_migrations advisory lock bilan
+    # navbatlashadi, schema yangi bo'lsa — bitta query. Leader faqat webhook
+    # va fon ishlar uchun (eski kod lock'ni ushlab turgan deploy'da ham ishlaydi)
     await db_init()
 
-    # Deployda eski update'lar yopirilib kelmasin:
-    # avval webhookni tozalab, pending'ni drop qilamiz
-    await bot.delete_webhook(drop_pending_updates=True)
+    # settings snapshot + boshqa worker/replikalardan invalidatsiya
+    # (avval LISTEN, keyin yuklash — oradagi o'zgarish yo'qolmasin)
+    on_notify(SETTINGS_CHANNEL, settings_reload)
+    on_notify(ADMINS_CHANNEL, admins_reload)
+    on_notify(CHANNELS_CHANNEL, channels_reload)
+    on_notify(BROADCAST_CHANNEL, broadcast_wakeup)
+    await notify_start()
+    await settings_reload()
+    await admins_reload()
+    await channels_reload()
+
+    # reyting xotiraga bir marta yuklanadi, keyin davriy DB bilan solishtiriladi
+    await leaderboard_load()
+    _background.append(asyncio.create_task(leaderboard_sync_loop(), name="leaderboard-sync"))
+
+    if update_queue is not None:
+        update_queue.start()
+
+    # leader bo'lsa on_elected (ensure_webhook) shu yerda ishlaydi — xato
+    # bo'lsa startup yiqiladi; bo'lmasa — leader o'lganda navbatdagi worker oladi
+    await leader.try_acquire()
+    await leader.start()
+
+
+@leader.on_elected
+async def ensure_webhook() -> None:
+    """
+    Webhook faqat URL / secret / allowed_updates o'zgargandagina qayta o'rnatiladi.
+    Redeploy paytida yig'ilgan update'lar saqlanadi (WEBHOOK_DROP_PENDING=1 — tashlash).
+    getWebhookInfo secret'ni qaytarmaydi, shuning uchun uning izi settings'da turadi.
+    """
+    allowed = sorted(dp.resolve_used_update_types())
+    fingerprint = hashlib.sha256(
+        "|".join([WEBHOOK_URL, TELEGRAM_SECRET_TOKEN, ",".join(allowed)]).encode()
+    ).hexdigest()
+
+    if not WEBHOOK_DROP_PENDING:
+        info = await bot.get_webhook_info()
+        if (
+            info.url == WEBHOOK_URL
+            and sorted(info.allowed_updates or []) == allowed
+            and await get_setting(WEBHOOK_FINGERPRINT_KEY, "") == fingerprint
+        ):
+            return
 
-    # Webhookni qayta o'rnatamiz
     kwargs = dict(
         url=WEBHOOK_URL,
-        allowed_updates=dp.resolve_used_update_types(),
+        allowed_updates=allowed,
+        drop_pending_updates=WEBHOOK_DROP_PENDING,
     )
 
     # agar TELEGRAM_SECRET_TOKEN berilsa, request header orqali tekshiramiz
@@ -69,10 +217,25 @@ async def on_startup():
         kwargs["secret_token"] = TELEGRAM_SECRET_TOKEN
 
     await bot.set_webhook(**kwargs)
+    await set_setting(WEBHOOK_FINGERPRINT_KEY, fingerprint)
+
+
+@leader.background
+async def broadcasts() -> None:
+    # /msg job'lari faqat leader'da yuboriladi; failover'da cursor'dan davom etadi
+    await broadcast_loop(bot)
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    # navbatdagi update'lar session/pool yopilishidan oldin tugatiladi
+    if update_queue is not None:
+        await update_queue.stop(drain=UPDATE_DRAIN_ON_SHUTDOWN, timeout=UPDATE_DRAIN_TIMEOUT)
+
+    for t in _background:
+        t.cancel()
+    await leader.stop()
+    await notify_stop()
     await bot.session.close()
     await db_close()
 
@@ -80,6 +243,31 @@ async def on_shutdown():
 # =========================
 # Routes
 # =========================
+class _InvalidJSON(Exception):
+    pass
+
+
+def _decode_update(body: bytes) -> Update:
+    """
+    Raw body -> Update, request.json() + alohida dict bosqichisiz.
+    orjson bor bo'lsa — C parser + validate (benchmarks/ da eng tezi);
+    yo'q bo'lsa — pydantic'ning o'z JSON parseri (model_validate_json).
+    """
+    if orjson is not None:
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            raise _InvalidJSON()
+        return Update.model_validate(data)
+
+    try:
+        return Update.model_validate_json(body)
+    except ValidationError as e:
+        if any(err.get("type") == "json_invalid" for err in e.errors()):
+            raise _InvalidJSON()
+        raise
+
+
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request) -> Response:
     # ixtiyoriy himoya: request Telegram'dan kelganini tekshirish
@@ -88,19 +276,44 @@ async def telegram_webhook(request: Request) -> Response:
         if hdr != TELEGRAM_SECRET_TOKEN:
             raise HTTPException(status_code=403, detail="Forbidden")
 
-    # JSON xato bo'lsa 400 qaytaramiz (500 emas)
-    try:
-        data = await request.json()
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid JSON")
+    body = await request.body()
 
-    # Pydantic validate
+    # Telegram retry: shu update_id allaqachon qabul qilingan bo'lsa — validate ham qilmaymiz
+    update_id = peek_update_id(body)
+    if update_id is not None and update_dedup.seen(update_id):
+        return Response(status_code=200)
+
+    # JSON xato bo'lsa ham, schema xato bo'lsa ham 400 qaytaramiz (500 emas)
     try:
-        update = Update.model_validate(data)
+        update = _decode_update(body)
+    except _InvalidJSON:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid update schema")
 
-    await dp.feed_update(bot, update)
+    # update_id boshida kelmagan bo'lsa (peek ishlamadi) — endi tekshiramiz
+    if update_id is None and update_dedup.seen(update.update_id):
+        return Response(status_code=200)
+
+    exempt = await _is_admin_update(update)
+    if not admission.admit(exempt=exempt):
+        # retryable: Telegram biroz kutib qayta yuboradi
+        return Response(status_code=429, headers={"Retry-After": str(SHED_RETRY_AFTER)})
+
+    update_dedup.add(update.update_id)
+
+    if update_queue is None:
+        await _feed_inline(update)
+        return Response(status_code=200)
+
+    # navbat to'la: 2xx bo'lmagan javob — Telegram keyinroq qayta yuboradi
+    if not update_queue.submit(update):
+        if exempt:
+            # admin update navbatdan tashqarida, shu request ichida
+            await _feed_inline(update)
+            return Response(status_code=200)
+        update_dedup.forget(update.update_id)
+        return Response(status_code=503)
     return Response(status_code=200)
 
 
@@ -109,9 +322,31 @@ async def health():
     return {"ok": True}
 
 
+# secret path ortida: ichki holat (navbat chuqurligi va h.k.)
+@app.get(f"/metrics/{WEBHOOK_SECRET}")
+async def metrics():
+    return {
+        "update_mode": UPDATE_MODE,
+        "queue": update_queue.stats() if update_queue is not None else None,
+        "leader": leader.stats(),
+        "dedup": update_dedup.stats(),
+        "leaderboard": leaderboard_stats(),
+        "notify": notify_stats(),
+        "admission": admission.stats(),
+        "subscriptions": subscriptions_stats(),
+        "ratelimit": rate_limiter.stats(),
+        "verify": verify_stats(),
+        "broadcast": broadcast_stats(),
+    }
+
+
 def main():
     # Railway port
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    if WEB_CONCURRENCY > 1:
+        # ko'p worker uchun uvicorn app'ni import string orqali oladi
+        uvicorn.run("main:app", host="0.0.0.0", port=PORT, workers=WEB_CONCURRENCY)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=PORT)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+"""
+Versiyalangan schema migratsiyalari.
+
+Har boot'da bitta query: schema_version tekshiriladi (env adminlar ham shu
+query ichida yoziladi). Schema eski bo'lsa — advisory lock olinadi va faqat
+yetishmayotgan qadamlar ketma-ket, har biri o'z tranzaksiyasida bajariladi.
+
+Yangi o'zgarish = MIGRATIONS oxiriga yangi (version, name, sql).
+Eski qadamlar o'zgartirilmaydi. schema.sql — faqat ma'lumot uchun nusxa.
+"""
+from typing import List, Tuple
+
+import asyncpg
+
+from config import ENV_ADMIN_IDS
+
+# bir vaqtda faqat bitta replika migratsiya qiladi
+MIGRATION_LOCK_KEY = 72810001
+
+
+# stats_counters'ni asosiy jadvallardan qayta hisoblash (migratsiya va /stats_rebuild).
+# Kunlar bo'yicha: jami = SUM(hammasi), bugun = SUM(day = CURRENT_DATE).
+#   users     — user yaratilgan kun
+#   verified  — verified user, u yaratilgan kun bo'yicha
+#   referrals — referral yaratilgan kun
+#   credited  — credited referral, u yaratilgan kun bo'yicha
+STATS_BACKFILL_SQL = """
+    INSERT INTO stats_counters(name, day, slot, value)
+    SELECT 'users', created_at::date, 0, COUNT(*) FROM users GROUP BY 2
+    UNION ALL
+    SELECT 'verified', created_at::date, 0, COUNT(*) FROM users WHERE verified GROUP BY 2
+    UNION ALL
+    SELECT 'referrals', created_at::date, 0, COUNT(*) FROM referrals GROUP BY 2
+    UNION ALL
+    SELECT 'credited', created_at::date, 0, COUNT(*) FROM referrals WHERE credited GROUP BY 2
+"""
+
+
+# referrer_scores'ni referrals'dan qayta hisoblash (migratsiya va /scores_rebuild).
+# created_at — referrer user'ning created_at'i (TOP'da teng ball bo'lsa tartib uchun),
+# first_credit_at — eski ma'lumotda taxminan: taklif qilingan user verified bo'lgan vaqt.
+SCORES_BACKFILL_SQL = """
+    INSERT INTO referrer_scores(user_id, score, first_credit_at, created_at)
+    SELECT r.referrer_id,
+           COUNT(*),
+           COALESCE(MIN(inv.verified_at), MIN(r.created_at)),
+           COALESCE(MIN(u.created_at), NOW())
+    FROM referrals r
+    LEFT JOIN users u ON u.user_id = r.referrer_id
+    LEFT JOIN users inv ON inv.user_id = r.invited_user_id
+    WHERE r.credited
+    GROUP BY r.referrer_id
+"""
+
+
+MIGRATIONS: List[Tuple[int, str, str]] = [
+    (1, "initial schema", """
+        CREATE TABLE IF NOT EXISTS users (
+          user_id BIGINT PRIMARY KEY,
+          username TEXT,
+          first_name TEXT,
+          referrer_id BIGINT NULL,
+          verified BOOLEAN NOT NULL DEFAULT FALSE,
+          verified_at TIMESTAMPTZ NULL,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer_id);
+        CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at);
+
+        CREATE TABLE IF NOT EXISTS channels (
+          id BIGSERIAL PRIMARY KEY,
+          username TEXT UNIQUE NOT NULL,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS referrals (
+          invited_user_id BIGINT PRIMARY KEY,
+          referrer_id BIGINT NOT NULL,
+          credited BOOLEAN NOT NULL DEFAULT FALSE,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        -- invited_user_id PRIMARY KEY bo'lgani uchun unique index shart emas,
+        -- lekin oldingi DB bilan moslik uchun qoldiramiz
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_referrals_invited ON referrals(invited_user_id);
+        CREATE INDEX IF NOT EXISTS idx_referrals_credited_referrer ON referrals(referrer_id, credited);
+
+        CREATE TABLE IF NOT EXISTS settings (
+          key TEXT PRIMARY KEY,
+          value TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS admins (
+          user_id BIGINT PRIMARY KEY,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS prizes (
+          id BIGSERIAL PRIMARY KEY,
+          place INT NOT NULL,
+          title TEXT NOT NULL,
+          description TEXT NOT NULL DEFAULT '',
+          created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS idx_prizes_place ON prizes(place);
+
+        INSERT INTO settings(key, value) VALUES
+          ('contest_active','1'),
+          ('ad_footer',''),
+          ('ad_btn_text',''),
+          ('ad_btn_url','')
+        ON CONFLICT (key) DO NOTHING;
+    """),
+    (2, "stats counters", """
+        CREATE TABLE IF NOT EXISTS stats_counters (
+          name TEXT NOT NULL,
+          day DATE NOT NULL,
+          slot SMALLINT NOT NULL,
+          value BIGINT NOT NULL DEFAULT 0,
+          PRIMARY KEY (name, day, slot)
+        );
+        DELETE FROM stats_counters;
+    """ + STATS_BACKFILL_SQL + ";"),
+    (3, "referrer scores", """
+        CREATE TABLE IF NOT EXISTS referrer_scores (
+          user_id BIGINT PRIMARY KEY,
+          score INT NOT NULL DEFAULT 0,
+          first_credit_at TIMESTAMPTZ NULL,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS idx_referrer_scores_rank ON referrer_scores(score DESC, created_at);
+        DELETE FROM referrer_scores;
+    """ + SCORES_BACKFILL_SQL + ";"),
+    (4, "channels chat_id", """
+        ALTER TABLE channels ADD COLUMN IF NOT EXISTS chat_id BIGINT NULL;
+    """),
+    (5, "channel members", """
+        CREATE TABLE IF NOT EXISTS channel_members (
+          user_id BIGINT NOT NULL,
+          channel_id BIGINT NOT NULL,
+          status TEXT NOT NULL,
+          updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+          PRIMARY KEY (user_id, channel_id)
+        );
+    """),
+    (6, "broadcast jobs", """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+          id BIGSERIAL PRIMARY KEY,
+          status TEXT NOT NULL DEFAULT 'pending',
+          created_by BIGINT NOT NULL,
+          src_chat_id BIGINT NOT NULL,
+          src_message_id BIGINT NOT NULL,
+          src_text TEXT NULL,
+          src_caption TEXT NULL,
+          extra_text TEXT NOT NULL DEFAULT '',
+          cursor_user_id BIGINT NOT NULL DEFAULT 0,
+          total INT NOT NULL DEFAULT 0,
+          sent INT NOT NULL DEFAULT 0,
+          failed INT NOT NULL DEFAULT 0,
+          created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+          started_at TIMESTAMPTZ NULL,
+          updated_at TIMESTAMPTZ NULL,
+          finished_at TIMESTAMPTZ NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_active
+          ON broadcast_jobs(id) WHERE status IN ('pending', 'running');
+    """),
+    (7, "blocked users", """
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ NULL;
+        CREATE INDEX IF NOT EXISTS idx_users_reachable ON users(user_id) WHERE blocked_at IS NULL;
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS blocked INT NOT NULL DEFAULT 0;
+    """),
+    (8, "broadcast segments", """
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS seg_verified BOOLEAN NOT NULL DEFAULT FALSE;
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS seg_since TIMESTAMPTZ NULL;
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS seg_top INT NULL;
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS seg_include_blocked BOOLEAN NOT NULL DEFAULT FALSE;
+        CREATE INDEX IF NOT EXISTS idx_users_verified_reachable
+          ON users(user_id) WHERE verified AND blocked_at IS NULL;
+    """),
+    (9, "broadcast payload", """
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS rendered BOOLEAN NOT NULL DEFAULT FALSE;
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS payload_text TEXT NULL;
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS reply_markup TEXT NULL;
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS media_type TEXT NULL;
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS media_file_id TEXT NULL;
+    """),
+    (10, "broadcast errors", """
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS errors INT NOT NULL DEFAULT 0;
+        ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS last_error TEXT NULL;
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# schema yangi bo'lsa — boot shu bitta query bilan tugaydi
+_BOOT_SQL = """
+    WITH env_admins AS (
+        INSERT INTO admins(user_id)
+        SELECT unnest($1::bigint[])
+        ON CONFLICT (user_id) DO NOTHING
+    )
+    SELECT COALESCE(MAX(version), 0) FROM schema_version
+"""
+
+_ENV_ADMINS_SQL = """
+    INSERT INTO admins(user_id)
+    SELECT unnest($1::bigint[])
+    ON CONFLICT (user_id) DO NOTHING
+"""
+
+
+async def _current_version(conn: asyncpg.Connection) -> int:
+    return int(await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version"))
+
+
+async def run_migrations(conn: asyncpg.Connection) -> int:
+    """
+    Schema'ni LATEST_VERSION gacha olib chiqadi. Qaytaradi: joriy versiya.
+    """
+    env_admins = [int(x) for x in ENV_ADMIN_IDS]
+
+    try:
+        version = int(await conn.fetchval(_BOOT_SQL, env_admins))
+    except asyncpg.UndefinedTableError:
+        version = 0
+
+    if version >= LATEST_VERSION:
+        return version
+
+    # boshqa replika ham shu payt migratsiya qilayotgan bo'lsa — kutamiz,
+    # keyin versiyani qayta o'qiymiz (u allaqachon hammasini qilgan bo'lishi mumkin)
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_KEY)
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+              version INT PRIMARY KEY,
+              name TEXT NOT NULL,
+              applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );
+        """)
+        version = await _current_version(conn)
+
+        for step, name, sql in MIGRATIONS:
+            if step <= version:
+                continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_version(version, name) VALUES($1, $2)",
+                    step, name,
+                )
+            version = step
+
+        await conn.execute(_ENV_ADMINS_SQL, env_admins)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_KEY)
+
+    return version
@@ -0,0 +1,113 @@
+"""
+Postgres LISTEN/NOTIFY orqali process'lararo cache invalidatsiya.
+
+Har process'da bitta alohida (pool'dan tashqari) connection. db.py yozuvchi
+funksiyalari o'z query'si ichida pg_notify(channel, payload) qiladi —
+tranzaksiya commit bo'lganda barcha worker/replikalarga yetib boradi.
+
+Connection uzilsa qayta ulanadi va barcha handler'lar payload=None bilan
+chaqiriladi (oradagi xabarlar yo'qolgan bo'lishi mumkin — to'liq reload).
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+import asyncpg
+
+from config import DATABASE_URL
+
+log = logging.getLogger(__name__)
+
+Handler = Callable[[Optional[str]], Awaitable[Any]]
+
+_handlers: Dict[str, List[Handler]] = {}
+_conn: Optional[asyncpg.Connection] = None
+_tasks: Set[asyncio.Task] = set()
+_reconnect_task: Optional[asyncio.Task] = None
+_stopping = False
+
+_RECONNECT_DELAY = 2.0
+
+received = 0
+
+
+def on_notify(channel: str, handler: Handler) -> None:
+    _handlers.setdefault(channel, []).append(handler)
+
+
+def _spawn(coro: Awaitable[Any]) -> None:
+    t = asyncio.ensure_future(coro)
+    _tasks.add(t)
+    t.add_done_callback(_tasks.discard)
+
+
+async def _run(handler: Handler, payload: Optional[str]) -> None:
+    try:
+        await handler(payload)
+    except Exception:
+        log.exception("notify handler xato: %s", getattr(handler, "__name__", handler))
+
+
+def _on_message(conn: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+    global received
+    received += 1
+    for h in _handlers.get(channel, ()):
+        _spawn(_run(h, payload))
+
+
+def _on_lost(conn: asyncpg.Connection) -> None:
+    global _reconnect_task
+    if _stopping:
+        return
+    log.warning("LISTEN connection uzildi — qayta ulanamiz")
+    if _reconnect_task is None or _reconnect_task.done():
+        _reconnect_task = asyncio.ensure_future(_reconnect())
+
+
+async def _connect() -> None:
+    global _conn
+    conn = await asyncpg.connect(dsn=DATABASE_URL)
+    conn.add_termination_listener(_on_lost)
+    for channel in _handlers:
+        await conn.add_listener(channel, _on_message)
+    _conn = conn
+
+
+async def _reconnect() -> None:
+    while not _stopping:
+        await asyncio.sleep(_RECONNECT_DELAY)
+        try:
+            await _connect()
+        except Exception:
+            log.exception("LISTEN qayta ulanish xato")
+            continue
+        # uzilish paytidagi xabarlar yo'qolgan — hammasini qayta yuklash
+        for hs in _handlers.values():
+            for h in hs:
+                _spawn(_run(h, None))
+        return
+
+
+async def notify_start() -> None:
+    global _stopping
+    _stopping = False
+    if _conn is None or _conn.is_closed():
+        await _connect()
+
+
+async def notify_stop() -> None:
+    global _conn, _stopping
+    _stopping = True
+    if _reconnect_task is not None:
+        _reconnect_task.cancel()
+    if _conn is not None and not _conn.is_closed():
+        await _conn.close()
+    _conn = None
+
+
+def notify_stats() -> Dict[str, Any]:
+    return {
+        "connected": _conn is not None and not _conn.is_closed(),
+        "channels": sorted(_handlers),
+        "received": received,
+    }
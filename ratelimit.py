@@ -0,0 +1,204 @@
+"""
+Bot API chiqish tezligi nazorati (token bucket).
+
+Bot session'ga request middleware sifatida ulanadi — bot.* chaqiruvlarining
+hammasi shu yerdan o'tadi:
+  * send*/copyMessage/forwardMessage — global bucket; broadcast (bulk())
+                                       ichida — o'rniga broadcast bucket'i +
+                                       har bir chat bucket'i
+  * getChatMember                    — alohida bucket
+  * qolganlari (answerCallbackQuery, getChat, ...) — cheklanmaydi
+
+Token yetmasa chaqiruv navbatda kutadi (tashlanmaydi). Interaktiv javoblar
+chat bucket'ida kutmaydi — u update worker'ini (shard'ni) yoki inflight
+slot'ni band qilib, boshqa user'larni ham to'xtatib qo'yardi; ular uchun
+chat limiti Telegram'ning RetryAfter javobi bilan ushlanadi (faqat shu
+chaqiruv kutib qayta yuboriladi). Broadcast'da RetryAfter kelsa tegishli
+bucket'lar retry_after sekundga to'xtatiladi.
+"""
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Hashable, Iterator, List, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+log = logging.getLogger(__name__)
+
+_SEND_METHODS = {"copyMessage", "copyMessages", "forwardMessage", "forwardMessages"}
+
+# broadcast runner yuborishlari (bulk()) — chat bucket'ida kutish mumkin
+_bulk: ContextVar[bool] = ContextVar("ratelimit_bulk", default=False)
+
+
+@contextmanager
+def bulk() -> Iterator[None]:
+    token = _bulk.set(True)
+    try:
+        yield
+    finally:
+        _bulk.reset(token)
+
+
+# shundan ko'p chat bucket'i bo'lsa — to'lgan (bo'sh turgan) bucket'lar tozalanadi
+_MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """
+    rate — sekundiga token, burst — sig'im. rate <= 0 — cheklov yo'q.
+    reserve() tokenni darhol band qiladi (manfiyga ham) va qancha kutish
+    kerakligini qaytaradi — navbat tartibi saqlanadi, lock kerak emas.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        if self.rate <= 0:
+            return max(0.0, self.paused_until - now)
+
+        self._refill(now)
+        self._tokens -= 1
+        wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float) -> None:
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + float(seconds))
+        if self.rate > 0:
+            self._refill(now)
+            self._tokens = min(self._tokens, 0.0)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        if self.rate > 0:
+            self._refill(now)
+        return self._tokens >= self.burst and self.paused_until <= now
+
+
+class BotRateLimiter(BaseRequestMiddleware):
+    def __init__(
+        self,
+        *,
+        global_rate: float,
+        chat_rate: float,
+        chat_burst: float,
+        group_per_min: float,
+        member_rate: float,
+        broadcast_rate: Optional[float] = None,
+        max_retries: int = 3,
+    ) -> None:
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        # bulk() yuborishlari o'z budjetidan (config.RATE_BROADCAST_SENDS) —
+        # broadcast faqat leader'da, interaktiv javoblar budjetini yemaydi
+        if broadcast_rate is None:
+            broadcast_rate = global_rate
+        self._broadcast = TokenBucket(broadcast_rate, max(1.0, broadcast_rate))
+        self._member = TokenBucket(member_rate, max(1.0, member_rate))
+        self._chat_rate = float(chat_rate)
+        self._chat_burst = float(chat_burst)
+        self._group_rate = float(group_per_min) / 60.0
+        self._chats: Dict[Hashable, TokenBucket] = {}
+        self._max_retries = int(max_retries)
+        self.waiting = 0
+        self.throttled_seconds = 0.0
+        self.retry_after = 0
+        self.requests = 0
+
+    def _chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is not None:
+            return b
+
+        if len(self._chats) >= _MAX_CHAT_BUCKETS:
+            for k in [k for k, v in self._chats.items() if v.idle()]:
+                del self._chats[k]
+
+        # manfiy id / @username — guruh yoki kanal (minutiga 20 ta)
+        is_group = not isinstance(chat_id, int) or chat_id < 0
+        if is_group:
+            b = TokenBucket(self._group_rate, self._chat_burst)
+        else:
+            b = TokenBucket(self._chat_rate, self._chat_burst)
+        self._chats[chat_id] = b
+        return b
+
+    def _buckets(self, method: Any) -> List[TokenBucket]:
+        api = getattr(method, "__api_method__", "")
+        if api == "getChatMember":
+            return [self._member]
+        if api.startswith("send") or api in _SEND_METHODS:
+            chat_id = getattr(method, "chat_id", None)
+            if not _bulk.get():
+                return [self._global]
+            if chat_id is None:
+                return [self._broadcast]
+            return [self._broadcast, self._chat_bucket(chat_id)]
+        return []
+
+    async def _take(self, bucket: TokenBucket) -> None:
+        wait = bucket.reserve()
+        if wait <= 0:
+            return
+
+        self.waiting += 1
+        try:
+            while wait > 0:
+                await asyncio.sleep(wait)
+                self.throttled_seconds += wait
+                # kutish paytida RetryAfter kelgan bo'lishi mumkin
+                wait = bucket.paused_until - time.monotonic()
+        finally:
+            self.waiting -= 1
+
+    async def __call__(self, make_request, bot, method):
+        buckets = self._buckets(method)
+        # interaktiv send: RetryAfter umumiy bucket'larni to'xtatmaydi
+        shared_pause = _bulk.get() or buckets != [self._global]
+        attempt = 0
+        while True:
+            for b in buckets:
+                await self._take(b)
+            self.requests += 1
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                if attempt >= self._max_retries or not buckets:
+                    raise
+                attempt += 1
+                log.warning(
+                    "RetryAfter %ss (%s), %s-urinish",
+                    e.retry_after, getattr(method, "__api_method__", "?"), attempt,
+                )
+                if shared_pause:
+                    for b in buckets:
+                        b.pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+                    self.throttled_seconds += e.retry_after
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "waiting": self.waiting,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "retry_after": self.retry_after,
+            "requests": self.requests,
+            "chat_buckets": len(self._chats),
+            "global_rate": self._global.rate,
+            "broadcast_rate": self._broadcast.rate,
+            "member_rate": self._member.rate,
+        }
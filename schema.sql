@@ -1,3 +1,14 @@
+-- Ma'lumot uchun: schema'ning joriy ko'rinishi.
+-- Haqiqiy manba — migrations.py (MIGRATIONS). O'zgarish faqat yangi migratsiya
+-- sifatida qo'shiladi, keyin bu fayl ham yangilanadi.
+
+-- schema_version (migrations.py boshqaradi)
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INT PRIMARY KEY,
+  name TEXT NOT NULL,
+  applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
 -- users
 CREATE TABLE IF NOT EXISTS users (
   user_id BIGINT PRIMARY KEY,
@@ -6,17 +17,22 @@ CREATE TABLE IF NOT EXISTS users (
   referrer_id BIGINT NULL,
   verified BOOLEAN NOT NULL DEFAULT FALSE,
   verified_at TIMESTAMPTZ NULL,
-  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  blocked_at TIMESTAMPTZ NULL  -- bot bloklangan / chat topilmadi (broadcast'da aniqlanadi)
 );
 
 CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer_id);
 CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at);
+-- broadcast faqat yetib boradigan user'larga
+CREATE INDEX IF NOT EXISTS idx_users_reachable ON users(user_id) WHERE blocked_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_users_verified_reachable ON users(user_id) WHERE verified AND blocked_at IS NULL;
 
 -- channels
 CREATE TABLE IF NOT EXISTS channels (
   id BIGSERIAL PRIMARY KEY,
   username TEXT UNIQUE NOT NULL,
-  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  chat_id BIGINT NULL  -- @username bir marta resolve qilingan numeric id
 );
 
 -- referrals
@@ -52,3 +68,76 @@ CREATE TABLE IF NOT EXISTS prizes (
 );
 
 CREATE INDEX IF NOT EXISTS idx_prizes_place ON prizes(place);
+
+-- stats_counters: /stats uchun write path'lar yuritadigan hisoblagichlar.
+-- slot — bitta issiq qatorda lock navbati bo'lmasligi uchun (o'qishda SUM)
+CREATE TABLE IF NOT EXISTS stats_counters (
+  name TEXT NOT NULL,
+  day DATE NOT NULL,
+  slot SMALLINT NOT NULL,
+  value BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (name, day, slot)
+);
+
+-- referrer_scores: har bir referrer'ning credited referral soni (TOP / rank uchun).
+-- credit_referrer_if_needed shu tranzaksiyada yangilaydi
+CREATE TABLE IF NOT EXISTS referrer_scores (
+  user_id BIGINT PRIMARY KEY,
+  score INT NOT NULL DEFAULT 0,
+  first_credit_at TIMESTAMPTZ NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_referrer_scores_rank ON referrer_scores(score DESC, created_at);
+
+-- channel_members: chat_member update'laridan (va getChatMember fallback'dan)
+-- yig'ilgan a'zolik holati. Tekshiruv: WHERE user_id=$1 AND channel_id=ANY($2)
+CREATE TABLE IF NOT EXISTS channel_members (
+  user_id BIGINT NOT NULL,
+  channel_id BIGINT NOT NULL,
+  status TEXT NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (user_id, channel_id)
+);
+
+-- broadcast_jobs: /msg navbati. status: pending | running | done | cancelled | failed.
+-- cursor_user_id — shu user_id'gacha (ORDER BY user_id) yuborib bo'lingan,
+-- restart'dan keyin shu joydan davom etiladi
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+  id BIGSERIAL PRIMARY KEY,
+  status TEXT NOT NULL DEFAULT 'pending',
+  created_by BIGINT NOT NULL,
+  src_chat_id BIGINT NOT NULL,
+  src_message_id BIGINT NOT NULL,
+  src_text TEXT NULL,
+  src_caption TEXT NULL,
+  extra_text TEXT NOT NULL DEFAULT '',
+  cursor_user_id BIGINT NOT NULL DEFAULT 0,
+  total INT NOT NULL DEFAULT 0,
+  sent INT NOT NULL DEFAULT 0,
+  failed INT NOT NULL DEFAULT 0,
+  blocked INT NOT NULL DEFAULT 0,
+  -- segment: faqat verified / shu vaqtdan keyin qo'shilgan / TOP-N referrer / bloklaganlar ham
+  seg_verified BOOLEAN NOT NULL DEFAULT FALSE,
+  seg_since TIMESTAMPTZ NULL,
+  seg_top INT NULL,
+  seg_include_blocked BOOLEAN NOT NULL DEFAULT FALSE,
+  -- job yaratilganda bir marta tayyorlangan payload (matn/caption + reklama,
+  -- reply_markup JSON); media_file_id — BROADCAST_MEDIA_MODE=file_id bo'lsa
+  rendered BOOLEAN NOT NULL DEFAULT FALSE,
+  payload_text TEXT NULL,
+  reply_markup TEXT NULL,
+  media_type TEXT NULL,
+  media_file_id TEXT NULL,
+  -- runner ketma-ket xatolari (chunk muvaffaqiyatli yozilsa 0 bo'ladi);
+  -- BROADCAST_MAX_ERRORS ga yetsa job 'failed' bo'ladi
+  errors INT NOT NULL DEFAULT 0,
+  last_error TEXT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  started_at TIMESTAMPTZ NULL,
+  updated_at TIMESTAMPTZ NULL,
+  finished_at TIMESTAMPTZ NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_active
+  ON broadcast_jobs(id) WHERE status IN ('pending', 'running');
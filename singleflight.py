@@ -0,0 +1,86 @@
+"""
+Bir xil kalit bo'yicha parallel chaqiruvlarni bitta bajarilishga birlashtirish.
+
+User tugmani ketma-ket 2-3 marta bossa: birinchi chaqiruv ishlaydi,
+qolganlari uning natijasini kutadi. Tugagandan keyin natija reuse_window
+sekund davomida qayta ishlatiladi.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+# shundan ko'p eslab qolingan natija bo'lsa — muddati o'tganlari tozalanadi
+_MAX_RECENT = 10000
+
+
+class SingleFlight:
+    def __init__(self, *, reuse_window: float = 0.0) -> None:
+        self._reuse_window = float(reuse_window)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._recent: Dict[Hashable, Tuple[float, Any]] = {}
+        self.executed = 0
+        self.joined = 0
+        self.reused = 0
+
+    def _remember(self, key: Hashable, result: Any) -> None:
+        now = time.monotonic()
+        if len(self._recent) >= _MAX_RECENT:
+            for k in [k for k, (exp, _) in self._recent.items() if exp <= now]:
+                del self._recent[k]
+        self._recent[key] = (now + self._reuse_window, result)
+
+    async def do(
+        self,
+        key: Hashable,
+        fn: Callable[[], Awaitable[Any]],
+        *,
+        reuse_if: Optional[Callable[[Any], bool]] = None,
+    ) -> Any:
+        """
+        reuse_if — natijani reuse_window davomida saqlash shartmi
+        (masalan, faqat muvaffaqiyatli natija). Parallel kutayotganlar
+        natijani baribir oladi.
+        """
+        recent = self._recent.get(key)
+        if recent is not None:
+            if recent[0] > time.monotonic():
+                self.reused += 1
+                return recent[1]
+            del self._recent[key]
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.joined += 1
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        # hech kim kutmasa "exception was never retrieved" bo'lmasin
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = fut
+        self.executed += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            if self._reuse_window > 0 and (reuse_if is None or reuse_if(result)):
+                self._remember(key, result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def forget(self, key: Hashable) -> None:
+        self._recent.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "executed": self.executed,
+            "joined": self.joined,
+            "reused": self.reused,
+            "inflight": len(self._inflight),
+        }
@@ -1,35 +1,294 @@
 import asyncio
-from typing import List, Tuple
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
 from aiogram import Bot
+from aiogram.types import InlineKeyboardButton
 
-from db import channel_list
+from config import (
+    SUB_CACHE_MEMBER_TTL, SUB_CACHE_NOT_MEMBER_TTL, SUB_CACHE_SIZE, SUB_RESOLVE_FAIL_TTL,
+    SUB_SINGLEFLIGHT_REUSE,
+)
+from db import channel_member_set, channel_member_statuses, channel_rows, channel_set_chat_id
+from keyboards import channel_button, set_channel_buttons
+from singleflight import SingleFlight
+
+log = logging.getLogger(__name__)
 
 OK_STATUSES = {"member", "administrator", "creator"}
 
 
-async def check_subscriptions(bot: Bot, user_id: int) -> Tuple[bool, List[str]]:
-    channels = await channel_list()
+# =========================
+# Kanallar cache
+# =========================
+# DB'dan bir marta o'qiladi; channel_add/channel_del/channel_set_chat_id
+# pg_notify(CHANNELS_CHANNEL) qiladi -> channels_reload (main.py'da ulangan).
+class Channel(NamedTuple):
+    username: str
+    chat_id: Optional[int]          # @username'dan resolve qilingan numeric id
+    button: InlineKeyboardButton    # kb_subscribe uchun tayyor tugma
+
+
+_channels: Optional[List[Channel]] = None
+
+# resolve bo'lmagan @username -> qayta urinish vaqti (monotonic). Har
+# check_subscriptions'da yangi getChat (u bucket'siz) + warning bo'lmasin
+_resolve_failed: Dict[str, float] = {}
+
+
+async def channels_reload(_payload: Optional[str] = None) -> None:
+    global _channels
+    _resolve_failed.clear()
+    rows = await channel_rows()
+    chans: List[Channel] = []
+    for i, r in enumerate(rows, start=1):
+        username = (r["username"] or "").strip()
+        if not username:
+            continue
+        chat_id = int(r["chat_id"]) if r["chat_id"] is not None else None
+        chans.append(Channel(username, chat_id, channel_button(i, username)))
+    set_channel_buttons({c.username: c.button for c in chans})
+    _channels = chans
+
+
+async def get_channels() -> List[Channel]:
+    if _channels is None:
+        await channels_reload()
+    return _channels
+
+
+async def resolve_chat_id(bot: Bot, username: str) -> Optional[int]:
+    """
+    @username -> numeric chat id (bir marta, keyin channels.chat_id'da saqlanadi).
+    """
+    if not username.startswith("@"):
+        return None
+    try:
+        chat = await bot.get_chat(username)
+    except Exception:
+        log.warning("kanal resolve bo'lmadi: %s", username)
+        return None
+    return int(chat.id)
+
+
+async def _chat_ref(bot: Bot, ch: Channel) -> Union[int, str]:
+    if ch.chat_id is not None:
+        return ch.chat_id
+
+    retry_at = _resolve_failed.get(ch.username)
+    if retry_at is not None and retry_at > time.monotonic():
+        return ch.username
+
+    chat_id = await resolve_chat_id(bot, ch.username)
+    if chat_id is None:
+        _resolve_failed[ch.username] = time.monotonic() + SUB_RESOLVE_FAIL_TTL
+        return ch.username
+    await channel_set_chat_id(ch.username, chat_id)
+    return chat_id
+
+
+# =========================
+# A'zolik cache (LRU)
+# =========================
+class MembershipCache:
+    """
+    (user_id, kanal) -> (a'zomi, muddati). OrderedDict — eng eski oxiridan
+    chiqariladi. "A'zo" uzoq, "a'zo emas" qisqa TTL bilan saqlanadi
+    (user obuna bo'lib darhol qayta bosadi).
+    """
+
+    def __init__(self, maxsize: int, member_ttl: float, not_member_ttl: float) -> None:
+        self._maxsize = max(0, int(maxsize))
+        self._member_ttl = float(member_ttl)
+        self._not_member_ttl = float(not_member_ttl)
+        self._data: "OrderedDict[Tuple[int, str], Tuple[bool, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0  # for_credit: "a'zo emas" yozuvi e'tiborsiz qoldirildi
+
+    def get(self, user_id: int, channel: str, *, trust_negative: bool = True) -> Optional[bool]:
+        key = (user_id, channel)
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        is_member, expires = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        if not is_member and not trust_negative:
+            self.bypassed += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return is_member
+
+    def put(self, user_id: int, channel: str, is_member: bool) -> None:
+        if self._maxsize == 0:
+            return
+        ttl = self._member_ttl if is_member else self._not_member_ttl
+        key = (user_id, channel)
+        self._data[key] = (is_member, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self._maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+membership_cache = MembershipCache(SUB_CACHE_SIZE, SUB_CACHE_MEMBER_TTL, SUB_CACHE_NOT_MEMBER_TTL)
+
+
+# channel_members / Telegram API hisoblagichlari
+_counters: Dict[str, int] = {"db_hits": 0, "db_writes": 0, "api_calls": 0, "pushed": 0}
+
+# (user_id, for_credit) -> bitta tekshiruv
+check_flight = SingleFlight(reuse_window=SUB_SINGLEFLIGHT_REUSE)
+
+
+def subscriptions_stats() -> Dict[str, Any]:
+    return {
+        "channels": len(_channels) if _channels is not None else None,
+        "unresolved": len(_resolve_failed),
+        "membership_cache": membership_cache.stats(),
+        "singleflight": check_flight.stats(),
+        **_counters,
+    }
+
+
+def _status_str(status: Any) -> str:
+    return str(getattr(status, "value", status) or "")
+
+
+async def record_chat_member(
+    chat_id: int, chat_username: Optional[str], user_id: int, status: Any, at: Optional[datetime] = None
+) -> bool:
+    """
+    chat_member update'dan: kuzatilayotgan kanal bo'lsa — holatni
+    channel_members'ga va xotiradagi cache'ga yozadi. Qaytaradi: yozildimi.
+    """
+    ch = None
+    for c in await get_channels():
+        if c.chat_id == chat_id:
+            ch = c
+            break
+        if c.chat_id is None and chat_username and c.username.lower() == f"@{chat_username}".lower():
+            # hali resolve qilinmagan kanal — id'ni shu yerdan olamiz
+            await channel_set_chat_id(c.username, chat_id)
+            ch = c
+            break
+    if ch is None:
+        return False
+
+    st = _status_str(status)
+    await channel_member_set(chat_id, user_id, st, at)
+    _counters["db_writes"] += 1
+    check_flight.forget((user_id, False))
+    check_flight.forget((user_id, True))
+    membership_cache.put(user_id, ch.username, st in OK_STATUSES)
+    _counters["pushed"] += 1
+    return True
+
+
+async def check_subscriptions(
+    bot: Bot, user_id: int, *, for_credit: bool = False
+) -> Tuple[bool, List[str]]:
+    """
+    Bir user uchun parallel chaqiruvlar bitta tekshiruvni bo'lishadi.
+    for_credit=True natijasi faqat muvaffaqiyatli bo'lsa qayta ishlatiladi.
+    """
+    return await check_flight.do(
+        (int(user_id), for_credit),
+        lambda: _check_subscriptions(bot, user_id, for_credit=for_credit),
+        reuse_if=(lambda r: r[0]) if for_credit else None,
+    )
+
+
+async def _check_subscriptions(
+    bot: Bot, user_id: int, *, for_credit: bool = False
+) -> Tuple[bool, List[str]]:
+    """
+    Tartib: xotiradagi cache -> channel_members (bitta query) -> getChatMember.
+    API faqat holati yozilmagan kanallar uchun chaqiriladi va natija
+    channel_members'ga yoziladi.
+
+    for_credit=True (confirm_sub): "a'zo emas" natijalari (cache'dagi ham,
+    DB'dagi ham) ishlatilmaydi — ball faqat Telegram'dan qayta so'ralgan
+    natija bilan.
+    """
+    channels = await get_channels()
     if not channels:
         return True, []
 
-    sem = asyncio.Semaphore(10)  # bir vaqtda 10 ta tekshiruv
     missing_set: set[str] = set()
+    pending: List[Channel] = []
+
+    for ch in channels:
+        cached = membership_cache.get(user_id, ch.username, trust_negative=not for_credit)
+        if cached is None:
+            pending.append(ch)
+        elif not cached:
+            missing_set.add(ch.username)
+
+    known = [ch.chat_id for ch in pending if ch.chat_id is not None]
+    if known:
+        statuses = await channel_member_statuses(user_id, known)
+        still: List[Channel] = []
+        for ch in pending:
+            st = statuses.get(ch.chat_id) if ch.chat_id is not None else None
+            if st is None:
+                still.append(ch)
+                continue
+            is_member = st in OK_STATUSES
+            if not is_member and for_credit:
+                still.append(ch)
+                continue
+            _counters["db_hits"] += 1
+            membership_cache.put(user_id, ch.username, is_member)
+            if not is_member:
+                missing_set.add(ch.username)
+        pending = still
 
-    async def check_one(ch: str) -> None:
-        ch = (ch or "").strip()
-        if not ch:
+    # parallellik ratelimit.py'dagi getChatMember bucket'i bilan cheklanadi
+    async def check_one(ch: Channel) -> None:
+        try:
+            chat_ref = await _chat_ref(bot, ch)
+            _counters["api_calls"] += 1
+            member = await bot.get_chat_member(chat_id=chat_ref, user_id=user_id)
+        except Exception:
+            # API xatosi — cache'ga yozmaymiz
+            missing_set.add(ch.username)
             return
 
-        async with sem:
+        st = _status_str(getattr(member, "status", None))
+        is_member = st in OK_STATUSES
+        membership_cache.put(user_id, ch.username, is_member)
+        if isinstance(chat_ref, int):
             try:
-                member = await bot.get_chat_member(chat_id=ch, user_id=user_id)
-                if getattr(member, "status", None) not in OK_STATUSES:
-                    missing_set.add(ch)
+                await channel_member_set(chat_ref, user_id, st)
+                _counters["db_writes"] += 1
             except Exception:
-                missing_set.add(ch)
+                log.exception("channel_members yozishda xato")
+        if not is_member:
+            missing_set.add(ch.username)
 
-    await asyncio.gather(*(check_one(ch) for ch in channels))
+    if pending:
+        await asyncio.gather(*(check_one(ch) for ch in pending))
 
     missing = sorted(missing_set)
     return (len(missing) == 0), missing
@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 from typing import Optional, Union
-import time
 
 from aiogram.types import Message, CallbackQuery
 
@@ -10,17 +9,9 @@ from db import (
     is_admin_db,
     is_contest_active,
     get_setting,
-    get_top1_score,
-    get_rank,
     get_stats_for_user,
 )
-
-# -------------------------
-# Simple cache (in-memory)
-# -------------------------
-_AD_CACHE_TTL = 60.0
-_ad_cache_value: str = ""
-_ad_cache_expire: float = 0.0
+from leaderboard import get_top1_score, get_rank
 
 
 def _env_admin_ids_set() -> set[int]:
@@ -31,20 +22,6 @@ def _env_admin_ids_set() -> set[int]:
         return set()
 
 
-async def _get_ad_footer_cached() -> str:
-    global _ad_cache_value, _ad_cache_expire
-
-    now = time.time()
-    if now < _ad_cache_expire:
-        return _ad_cache_value
-
-    footer = (await get_setting("ad_footer", "")).strip()
-
-    _ad_cache_value = footer
-    _ad_cache_expire = now + _AD_CACHE_TTL
-    return footer
-
-
 # =========================
 # Motivation / Referral
 # =========================
@@ -83,8 +60,17 @@ async def build_motivation_text(referrer_id: int) -> str:
     )
 
 
+def is_env_admin(user_id: int) -> bool:
+    # .env orqali berilgan admin — DB'dan o'chirib bo'lmaydi
+    return int(user_id) in _env_admin_ids_set()
+
+
 async def is_admin(user_id: int) -> bool:
-    if int(user_id) in _env_admin_ids_set():
+    """
+    Ikkala router uchun yagona tekshiruv: env adminlar + DB adminlar keshi
+    (db.is_admin_db xotiradan o'qiydi, o'zgarsa NOTIFY bilan yangilanadi).
+    """
+    if is_env_admin(user_id):
         return True
     return bool(await is_admin_db(int(user_id)))
 
@@ -106,7 +92,8 @@ def parse_ref_code(code: str) -> Optional[int]:
 # Ads
 # =========================
 async def merge_text_with_ad(text: str) -> str:
-    footer = await _get_ad_footer_cached()
+    # settings snapshot'dan (xotira), o'zgarsa NOTIFY orqali yangilanadi
+    footer = (await get_setting("ad_footer", "")).strip()
     if footer:
         if text.strip():
             return f"{text}\n\n{footer}"